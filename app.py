@@ -1,49 +1,510 @@
-from flask import Flask, request, redirect, jsonify, abort
+import csv
+import hmac
+import io
+import os
+import time
+import uuid
+import click
+from functools import partial, wraps
+from flask import Blueprint, Flask, Response, current_app, g, request, redirect, jsonify, abort, send_from_directory
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from model import SubscriberModel, db
-from modules import send_subscription_alert, subscriber_pull
+from database import init_database
+from sharding import init_shards, create_shard_tables, subscriber_engines, find_subscriber, add_subscriber, \
+    write_batches, move_to_shards
+from modules import send_subscription_alert, subscriber_pull, reprobe_quarantined, voice_escalate, \
+    subscriber_added, unsubscribe_subscriber, subscribers_patched, recipients_changed, plan_segments, audience_index, \
+    CHUNK_SIZE
+from msisdn import normalize_msisdn, msisdn_to_e164
+from importer import detect_format, import_subscribers, upsert_batch, IMPORT_ENCODING, IMPORT_FORMATS
+from exporter import export_ndjson, gzip_stream
+from suppression import suppression_list, is_stop_request
+from quarantine import record_delivery_report
+from voice import call_dispatcher
+from broadcast import broadcasts, ALERT_TTL
+from escalation import EscalationPolicy, ESCALATION_RATIO, ESCALATION_DEADLINE
+from scheduler import alert_scheduler, parse_due_at, local_timezone
+from audience import parse
+from geo import parse_area, parse_location
+from planner import plan_broadcast
+from carriers import carrier_of, classify_unknown
+from stats import install_stats, reconcile_stats, subscriber_stats, start_reconciler
+from tenancy import load_tenants, tenant_instance_path, tenant_name
+from metrics import registry, request_latency
+from senders import sender_pool
+from migrate import migrate
+from tracing import broadcast_trace, recent_traces, flush_traces, start_trace_flusher
+from logs import init_logging
+from profiler import profiler
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///sample_db.db'
-app.config["SQLALCHEMY_TRACK_MODIFICATION"] = False
-db.init_app(app)
+views = Blueprint("dharura", __name__, cli_group=None)
 
-@app.before_first_request
+
+def create_app(tenant=None):
+    # tenant: a key of instance/tenants.json; its settings override the defaults
+    # and its data lives in its own instance folder
+    if tenant is None:
+        app = Flask(__name__)
+    else:
+        app = Flask(__name__, instance_path=tenant_instance_path(tenant))
+    app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///sample_db.db'
+    app.config["SQLALCHEMY_TRACK_MODIFICATION"] = False
+    app.config["SUBSCRIBER_SHARDS"] = int(os.environ.get("SUBSCRIBER_SHARDS", 0))
+    app.config["TENANT"] = tenant
+    app.config["SMS_SENDER"] = "32721"
+    # Sender pool, e.g. ["32721", {"id": "DHARURA", "rate": 50}]; None sends from SMS_SENDER only
+    app.config["SMS_SENDERS"] = None
+    app.config["REDIRECT_URL"] = 'https://emergency-system.netlify.app/'
+    # Naive send_at/since times are local; East Africa Time is UTC+3 all year
+    app.config["UTC_OFFSET_HOURS"] = 3
+    # Caller ID for voice calls; critical alerts and voice escalation are refused until it is set
+    app.config["VOICE_NUMBER"] = None
+    # Recipients per second for this tenant, None for no budget
+    app.config["SMS_RATE_BUDGET"] = None
+    app.config["FAIR_SHARE_WEIGHT"] = 1
+    # Recipients per second per operator gateway, e.g. {"Vodacom": 200}; unlisted carriers aren't shaped
+    app.config["CARRIER_RATES"] = {}
+    # Bearer token for admin endpoints (subscriber data, profiling); they refuse every request while unset
+    app.config["ADMIN_TOKEN"] = os.environ.get("DHARURA_ADMIN_TOKEN")
+    # Deployed version, stored with every broadcast trace
+    app.config["RELEASE"] = os.environ.get("DHARURA_RELEASE")
+    if tenant is not None:
+        app.config.update(load_tenants()[tenant])
+        os.makedirs(app.instance_path, exist_ok=True)
+    init_logging()
+    init_database(app)
+    init_shards(app)
+    app.register_blueprint(views)
+    return app
+
+
+@views.before_app_first_request
 def create_tables():
     db.create_all()
+    create_shard_tables()
+    migrate(subscriber_engines())
+    install_stats()
+    reconcile_stats()
+    start_reconciler(current_app._get_current_object())
+    start_trace_flusher(current_app._get_current_object())
+    alert_scheduler.start(current_app._get_current_object())
+
+
+def admin_only(view):
+    # Requires "Authorization: Bearer <ADMIN_TOKEN>"
+    @wraps(view)
+    def check(*args, **kwargs):
+        token = current_app.config.get("ADMIN_TOKEN")
+        supplied = request.headers.get("Authorization", "")
+        if not token or not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+            return jsonify({"STAT": "Not Authorized"}), 401
+        return view(*args, **kwargs)
+    return check
+
+
+@views.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profiled = profiler.begin("request")
+
+
+@views.after_app_request
+def record_request_latency(response):
+    if request.endpoint is not None and "request_started" in g:
+        request_latency.observe(time.perf_counter() - g.request_started, tenant_name(), request.endpoint,
+                                request.method)
+    return response
+
 
+@views.teardown_app_request
+def stop_request_profile(exc):
+    if g.get("profiled"):
+        profiler.end()
 
-@app.route("/subscribe", methods=['POST'])
+
+@views.route("/metrics", methods=['GET'])
+@admin_only
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@views.route("/subscribe", methods=['POST'])
 def subscriber_register():
     if request.method == 'POST':
-        msisdn = request.form['phoneNumber']
+        msisdn = normalize_msisdn(request.form['phoneNumber'])
         occupation = request.form['Occupation']
-        if msisdn[:1] == "+" and msisdn[:4] == "+255":
+        latitude, longitude = None, None
+        if request.form.get('Latitude') or request.form.get('Longitude'):
+            try:
+                latitude, longitude = parse_location(request.form.get('Latitude'), request.form.get('Longitude'))
+            except (TypeError, ValueError):
+                return jsonify({"STAT": "Location Not Clear"})
+        if msisdn is not None:
             if occupation == "Staff" or occupation == "Student":
-                if SubscriberModel.query.filter_by(msisdn=msisdn).first() is None:
-                    subscriber = SubscriberModel(msisdn=msisdn, occupation=occupation)
-                    db.session.add(subscriber)
-                    db.session.commit()
-                    send_subscription_alert(msisdn)
+                if find_subscriber(msisdn) is None:
+                    subscriber = SubscriberModel(msisdn=msisdn, occupation=occupation,
+                                                 campus=request.form.get('Campus'),
+                                                 language=request.form.get('Language'),
+                                                 hostel=request.form.get('Hostel'),
+                                                 faculty=request.form.get('Faculty'),
+                                                 zone=request.form.get('Zone'),
+                                                 latitude=latitude, longitude=longitude,
+                                                 carrier=carrier_of(msisdn))
+                    subscriber_added(add_subscriber(subscriber), subscriber)
+                    if msisdn in suppression_list:
+                        suppression_list.remove(msisdn)
+                        subscribers_patched()
+                    send_subscription_alert(msisdn_to_e164(msisdn))
 
-                    return redirect('https://emergency-system.netlify.app/')
+                    return redirect(current_app.config["REDIRECT_URL"])
                 else:
-                    return jsonify({"STAT": "Occupation Not Clear"})
+                    return jsonify({"STAT": "Subscriber Registered"})
             else:
-                return jsonify({"STAT": "Subscriber Registered"})
+                return jsonify({"STAT": "Occupation Not Clear"})
         else:
             return jsonify({"STAT": "MSISDN/Phone Number Not Clear"})
     else:
         return abort(403)
 
 
-@app.route("/push_notification", methods=['POST'])
+@views.route("/subscribe", methods=['DELETE'])
+def subscriber_unregister():
+    msisdn = normalize_msisdn(request.values.get('phoneNumber'))
+    if msisdn is None:
+        return jsonify({"STAT": "MSISDN/Phone Number Not Clear"})
+
+    unsubscribe_subscriber(msisdn)
+    return jsonify({"STAT": "Subscriber Unsubscribed"})
+
+
+@views.route("/sms/inbound", methods=['POST'])
+def sms_inbound():
+    msisdn = normalize_msisdn(request.form.get('from'))
+    if msisdn is not None and is_stop_request(request.form.get('text')):
+        unsubscribe_subscriber(msisdn)
+    return "", 200
+
+
+@views.route("/sms/delivery", methods=['POST'])
+def sms_delivery_report():
+    msisdn = normalize_msisdn(request.form.get('phoneNumber'))
+    if msisdn is not None:
+        if record_delivery_report(msisdn, request.form.get('status'), request.form.get('failureReason')):
+            recipients_changed()
+    broadcasts.delivery_report(request.form.get('id'), request.form.get('status'))
+    return "", 200
+
+
+@views.route("/voice/callback", methods=['POST'])
+def voice_callback():
+    active = request.form.get('isActive') == '1'
+    for field in ('destinationNumber', 'callerNumber'):
+        msisdn = normalize_msisdn(request.form.get(field))
+        if msisdn is None:
+            continue
+        document = call_dispatcher.say(msisdn, active)
+        if document is not None:
+            return Response(document, mimetype='application/xml')
+    return "", 200
+
+
+ESCALATION_FIELDS = ('escalate_below', 'escalate_after', 'escalate_via')
+
+
+def alert_options(form):
+    # Returns (options, None) or (None, STAT message) for the alert form fields.
+    # Escalation relies on delivery reports, so it only applies when asked for.
+    policy = None
+    if any(form.get(field) for field in ESCALATION_FIELDS):
+        try:
+            policy = EscalationPolicy(
+                ratio=float(form.get('escalate_below') or ESCALATION_RATIO * 100) / 100,
+                deadline=float(form.get('escalate_after') or ESCALATION_DEADLINE),
+                channel=form.get('escalate_via') or 'sms',
+            )
+        except ValueError:
+            return None, "Escalation Policy Not Clear"
+    critical = form.get('critical') == '1'
+    voice_escalation = policy is not None and policy.channel == "voice"
+    if (critical or voice_escalation) and not current_app.config["VOICE_NUMBER"]:
+        return None, "Voice Not Configured"
+
+    try:
+        ttl = int(form.get('ttl', ALERT_TTL))
+    except ValueError:
+        return None, "TTL Not Clear"
+    if ttl <= 0:
+        # Every chunk would be discarded as expired before it is sent
+        return None, "TTL Not Clear"
+
+    audience = form.get('audience') or None
+    if audience is not None:
+        try:
+            parse(audience)
+        except ValueError:
+            return None, "Audience Not Clear"
+    try:
+        area = parse_area(form.get('lat'), form.get('lon'), form.get('radius'), form.get('polygon'))
+    except (TypeError, ValueError):
+        return None, "Area Not Clear"
+
+    try:
+        due_at = parse_due_at(form.get('send_at'), form.get('delay'),
+                              local_timezone(current_app.config["UTC_OFFSET_HOURS"]))
+    except ValueError:
+        return None, "Schedule Not Clear"
+
+    return {
+        "policy": policy,
+        "ttl": ttl,
+        "critical": critical,
+        "incident": form.get('incident') or None,
+        "audience": audience,
+        "area": area,
+        "due_at": due_at,
+    }, None
+
+
+@views.route("/push_notification", methods=['POST'])
 def push_notification():
     title = request.form['title']
     description = request.form['description']
+    options, error = alert_options(request.form)
+    if error is not None:
+        return jsonify({"STAT": error})
+
+    if options["due_at"] is not None:
+        alert = alert_scheduler.schedule(title, description, options["due_at"], options["critical"],
+                                         options["ttl"], options["incident"], options["audience"], options["area"],
+                                         options["policy"])
+        return jsonify({"STAT": "Alert Scheduled", "id": alert.id, "due_at": options["due_at"].isoformat() + "Z"})
+
+    broadcast = subscriber_pull(title, description, options["policy"], options["ttl"], options["incident"],
+                                options["audience"], options["area"])
+    if options["critical"]:
+        voice_escalate(broadcast, title, description, options["audience"], options["area"])
+
+    return redirect(current_app.config["REDIRECT_URL"])
+
+
+@views.route("/push_notification/plan", methods=['POST'])
+def push_notification_plan():
+    title = request.form['title']
+    description = request.form['description']
+    options, error = alert_options(request.form)
+    if error is not None:
+        return jsonify({"STAT": error})
+
+    voice_message = f"Emergency. {title}. {description}" if options["critical"] else None
+    segments, carriers = plan_segments(options["audience"], options["area"])
+    plan = plan_broadcast(f"{title}, {description}", segments, carriers, CHUNK_SIZE, voice_message,
+                          call_dispatcher.concurrency, sender_pool.rate(), current_app.config["SMS_RATE_BUDGET"],
+                          current_app.config["CARRIER_RATES"])
+    return jsonify({"STAT": "Plan", **plan})
+
+
+@views.route("/push_notification/<int:alert_id>", methods=['DELETE'])
+def cancel_scheduled_notification(alert_id):
+    if alert_scheduler.cancel(alert_id):
+        return jsonify({"STAT": "Alert Cancelled"})
+    return jsonify({"STAT": "Scheduled Alert Not Found"}), 404
+
+
+@views.route("/broadcasts/<broadcast_id>", methods=['GET'])
+def broadcast_status(broadcast_id):
+    broadcast = broadcasts.get(broadcast_id)
+    if broadcast is None:
+        return jsonify({"STAT": "Broadcast Not Found"}), 404
+    return jsonify(broadcast.counters())
+
+
+@views.route("/broadcasts/<broadcast_id>/trace", methods=['GET'])
+def broadcast_trace_status(broadcast_id):
+    trace = broadcast_trace(broadcast_id)
+    if trace is None:
+        return jsonify({"STAT": "Broadcast Not Found"}), 404
+    return jsonify(trace)
+
+
+@views.route("/traces", methods=['GET'])
+def traces():
+    try:
+        since = parse_due_at(request.args.get('since'), local=local_timezone(current_app.config["UTC_OFFSET_HOURS"]))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"STAT": "Query Not Clear"}), 400
+    flush_traces()
+    rows, summary = recent_traces(since, request.args.get('release'), limit)
+    return jsonify({"traces": rows, "summary": summary})
+
+
+@views.route("/profiling", methods=['GET', 'POST'])
+@admin_only
+def profiling():
+    # POST rate=0.05 profiles that fraction of requests and dispatched chunks; rate=0 stops
+    if request.method == 'POST':
+        try:
+            profiler.configure(float(request.form['rate']))
+        except (KeyError, ValueError):
+            return jsonify({"STAT": "Rate Not Clear"}), 400
+    return jsonify(profiler.status())
+
+
+@views.route("/profiling/dump", methods=['POST'])
+@admin_only
+def profiling_dump():
+    path = profiler.dump()
+    if path is None:
+        return jsonify({"STAT": "No Samples"}), 404
+    return jsonify({"STAT": "Profile Written", "path": path})
+
+
+@views.route("/senders", methods=['GET'])
+def sender_status():
+    return jsonify({"senders": sender_pool.status()})
+
+
+@views.route("/stats", methods=['GET'])
+def stats():
+    return jsonify({**subscriber_stats(), "suppressed": len(suppression_list)})
+
+
+@views.route("/audience", methods=['GET'])
+@admin_only
+def audience_size():
+    expression = request.args.get('q', 'all')
+    try:
+        size = audience_index.count(expression)
+    except ValueError:
+        return jsonify({"STAT": "Audience Not Clear"}), 400
+
+    result = {"audience": expression, "size": size}
+    msisdn = normalize_msisdn(request.args.get('phoneNumber'))
+    if msisdn is not None:
+        found = find_subscriber(msisdn)
+        result["member"] = found is not None and found[0] in audience_index.targetable(expression)
+    return jsonify(result)
+
+
+@views.route("/subscribers/import", methods=['POST'])
+@admin_only
+def subscriber_import():
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"STAT": "Import File Missing"}), 400
+
+    try:
+        fmt = detect_format(upload.filename, request.form.get('format'))
+    except ValueError as e:
+        return jsonify({"STAT": "Import Format Not Clear", "error": str(e)}), 400
+    report_dir = os.path.join(current_app.instance_path, 'imports')
+    os.makedirs(report_dir, exist_ok=True)
+    report = f"{uuid.uuid4().hex}.rejects.csv"
+
+    stream = io.TextIOWrapper(upload.stream, encoding=IMPORT_ENCODING, newline='')
+    with open(os.path.join(report_dir, report), 'w', newline='') as rejects:
+        summary = import_subscribers(partial(write_batches, upsert_batch), stream, fmt, csv.writer(rejects))
+    recipients_changed()
+
+    if "error" in summary:
+        return jsonify({"STAT": "Import File Not Clear", "report": report, **summary}), 400
+    return jsonify({"STAT": "Import Complete", "report": report, **summary})
+
+
+@views.route("/subscribers/import/<report>", methods=['GET'])
+@admin_only
+def subscriber_import_report(report):
+    return send_from_directory(os.path.join(current_app.instance_path, 'imports'), report, mimetype='text/csv')
+
+
+@views.route("/subscribers/export", methods=['GET'])
+@admin_only
+def subscriber_export():
+    body = export_ndjson(subscriber_engines())
+    headers = {"Content-Disposition": "attachment; filename=subscribers.ndjson"}
+    if request.args.get('gzip') == '1' or 'gzip' in request.accept_encodings:
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(body, mimetype='application/x-ndjson', headers=headers)
+
+
+@views.cli.command("import-subscribers")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(IMPORT_FORMATS), default=None)
+@click.option("--rejects", "rejects_path", type=click.Path(dir_okay=False), default=None)
+def import_subscribers_command(path, fmt, rejects_path):
+    db.create_all()
+    create_shard_tables()
+    install_stats()
+    try:
+        fmt = detect_format(path, fmt)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    rejects_path = rejects_path or f"{path}.rejects.csv"
+    with open(path, encoding=IMPORT_ENCODING, newline='') as stream, open(rejects_path, 'w', newline='') as rejects:
+        summary = import_subscribers(partial(write_batches, upsert_batch), stream, fmt, csv.writer(rejects))
+    recipients_changed()
+    click.echo(f"{summary['rows']} rows, {summary['upserted']} upserted, "
+               f"{summary['rejected']} rejected (see {rejects_path})")
+    if "error" in summary:
+        raise click.ClickException(summary["error"])
+
+
+@views.cli.command("reprobe-quarantine")
+def reprobe_quarantine_command():
+    db.create_all()
+    click.echo(f"{reprobe_quarantined()} quarantined numbers probed")
+
+
+@views.cli.command("shard-subscribers")
+def shard_subscribers_command():
+    if not current_app.config["SUBSCRIBER_SHARDS"] > 1:
+        raise click.UsageError("Set SUBSCRIBER_SHARDS above 1 first")
+    db.create_all()
+    create_shard_tables()
+    install_stats()
+    click.echo(f"{move_to_shards()} subscribers moved into {current_app.config['SUBSCRIBER_SHARDS']} shards")
+    reconcile_stats()
+    recipients_changed()
+
+
+@views.cli.command("classify-carriers")
+def classify_carriers_command():
+    db.create_all()
+    create_shard_tables()
+    click.echo(f"{sum(classify_unknown(engine) for engine in subscriber_engines())} subscribers classified")
+    recipients_changed()
+
+
+@views.cli.command("migrate-db")
+def migrate_db_command():
+    # Brings a database from any earlier schema up to date; safe to rerun
+    db.create_all()
+    create_shard_tables()
+    report = migrate(subscriber_engines())
+    install_stats()
+    reconcile_stats()
+    recipients_changed()
+    click.echo(f"{len(report['added'])} columns added, {report['normalized']} numbers normalized, "
+               f"{report['dropped']} unusable rows dropped, {report['classified']} subscribers classified")
+
+
+@views.cli.command("reconcile-stats")
+def reconcile_stats_command():
+    db.create_all()
+    create_shard_tables()
+    install_stats()
+    reconcile_stats()
+    click.echo(subscriber_stats())
 
-    subscriber_pull(title, description)
 
-    return redirect('https://emergency-system.netlify.app/')
+app = create_app()
+# Each tenant is served under its own path prefix, e.g. /udsm/subscribe
+tenant_apps = {tenant: create_app(tenant) for tenant in load_tenants()}
+if tenant_apps:
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {f"/{tenant}": tenant_app
+                                                       for tenant, tenant_app in tenant_apps.items()})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,232 @@
+import re
+import threading
+from array import array
+from bitmap import RoaringBitmap
+from importer import OCCUPATIONS
+from carriers import carrier_of
+
+ATTRIBUTES = ("occupation", "campus", "language", "hostel", "faculty", "zone")
+SEGMENT_ATTRIBUTE = "occupation"
+FLAGS = ("suppressed", "quarantined")
+UNKNOWN_CARRIER = "Other"
+
+_token = re.compile(r'\s*("[^"]*"|\(|\)|=|[^\s()="]+)')
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _token.match(expression, position)
+        if match is None:
+            raise ValueError(f"Unexpected input at {position}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def parse(expression):
+    # expr := term (OR term)*, term := factor (AND factor)*,
+    # factor := NOT factor | '(' expr ')' | name '=' value | name
+    tokens = tokenize(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError("Unexpected end of audience expression")
+        position += 1
+        return tokens[position - 1]
+
+    def keyword(word):
+        token = peek()
+        return token is not None and token.upper() == word
+
+    def expr():
+        node = term()
+        while keyword("OR"):
+            take()
+            node = ("or", node, term())
+        return node
+
+    def term():
+        node = factor()
+        while keyword("AND"):
+            take()
+            node = ("and", node, factor())
+        return node
+
+    def factor():
+        if keyword("NOT"):
+            take()
+            return ("not", factor())
+        token = take()
+        if token == "(":
+            node = expr()
+            if take() != ")":
+                raise ValueError("Expected )")
+            return node
+        if token in (")", "="):
+            raise ValueError(f"Unexpected {token}")
+        if peek() == "=":
+            take()
+            attribute = token.lower()
+            if attribute not in ATTRIBUTES:
+                raise ValueError(f"Unknown attribute: {token}")
+            return ("eq", attribute, take().strip('"'))
+        name = token.strip('"')
+        # Bare names are a closed set, so a typo fails here instead of matching nobody
+        if name.lower() != "all" and name.lower() not in FLAGS and name not in OCCUPATIONS:
+            raise ValueError(f"Unknown segment: {name}")
+        return ("name", name)
+
+    node = expr()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected {tokens[position]}")
+    return node
+
+
+class BitmapIndex:
+    def __init__(self, loader, flag_loader, data_version=None):
+        # loader() yields (id, msisdn, *ATTRIBUTES) rows ordered by id,
+        # flag_loader(flag) yields the ids carrying one of FLAGS, and
+        # data_version() changes when another process rewrites them in bulk
+        self._loader = loader
+        self._flag_loader = flag_loader
+        self._data_version = data_version
+        self._loaded_version = None
+        self._values = None
+        self._flags = None
+        self._carriers = None
+        self._all = None
+        self._msisdns = array("q")
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def _ensure(self):
+        current = self._data_version() if self._data_version else None
+        if self._values is not None and current == self._loaded_version:
+            return
+        ids = {attribute: {} for attribute in ATTRIBUTES}
+        carriers = {}
+        everyone = []
+        msisdns = array("q")
+        for row in self._loader():
+            subscriber_id, msisdn = row[0], row[1]
+            everyone.append(subscriber_id)
+            if subscriber_id >= len(msisdns):
+                msisdns.extend([0] * (subscriber_id + 1 - len(msisdns)))
+            msisdns[subscriber_id] = msisdn
+            carriers.setdefault(carrier_of(msisdn) or UNKNOWN_CARRIER, []).append(subscriber_id)
+            for attribute, value in zip(ATTRIBUTES, row[2:]):
+                if value is not None:
+                    ids[attribute].setdefault(value, []).append(subscriber_id)
+        self._values = {
+            attribute: {value: RoaringBitmap.from_sorted(members) for value, members in values.items()}
+            for attribute, values in ids.items()
+        }
+        self._flags = {flag: RoaringBitmap.from_sorted(sorted(self._flag_loader(flag))) for flag in FLAGS}
+        self._carriers = {carrier: RoaringBitmap.from_sorted(members) for carrier, members in carriers.items()}
+        self._all = RoaringBitmap.from_sorted(everyone)
+        self._msisdns = msisdns
+        self._loaded_version = current
+
+    def caught_up(self, version):
+        # This process moved the data version to version and already patched
+        # itself; only a change from elsewhere makes it reload
+        with self._lock:
+            if self._loaded_version is not None and self._loaded_version == version - 1:
+                self._loaded_version = version
+
+    def add(self, subscriber_id, msisdn, attributes):
+        with self._lock:
+            if self._values is None:
+                return
+            if subscriber_id >= len(self._msisdns):
+                self._msisdns.extend([0] * (subscriber_id + 1 - len(self._msisdns)))
+            self._msisdns[subscriber_id] = msisdn
+            self._all.add(subscriber_id)
+            self._carriers.setdefault(carrier_of(msisdn) or UNKNOWN_CARRIER, RoaringBitmap()).add(subscriber_id)
+            for attribute in ATTRIBUTES:
+                value = attributes.get(attribute)
+                if value is not None:
+                    self._values[attribute].setdefault(value, RoaringBitmap()).add(subscriber_id)
+
+    def flag(self, flag, subscriber_id):
+        with self._lock:
+            if self._values is not None:
+                self._flags[flag].add(subscriber_id)
+
+    def remove(self, subscriber_id):
+        with self._lock:
+            if self._values is None:
+                return
+            self._all.discard(subscriber_id)
+            for values in self._values.values():
+                for bitmap in values.values():
+                    bitmap.discard(subscriber_id)
+            for bitmap in self._flags.values():
+                bitmap.discard(subscriber_id)
+            for bitmap in self._carriers.values():
+                bitmap.discard(subscriber_id)
+
+    def _evaluate(self, node):
+        kind = node[0]
+        if kind == "or":
+            return self._evaluate(node[1]) | self._evaluate(node[2])
+        if kind == "and":
+            return self._evaluate(node[1]) & self._evaluate(node[2])
+        if kind == "not":
+            return self._all - self._evaluate(node[1])
+        if kind == "eq":
+            return self._values[node[1]].get(node[2], RoaringBitmap())
+        name = node[1]
+        if name.lower() == "all":
+            return self._all
+        if name.lower() in self._flags:
+            return self._flags[name.lower()]
+        return self._values[SEGMENT_ATTRIBUTE].get(name, RoaringBitmap())
+
+    def evaluate(self, expression):
+        node = parse(expression) if isinstance(expression, str) else expression
+        with self._lock:
+            self._ensure()
+            return self._evaluate(node).copy()
+
+    def targetable(self, expression):
+        # Quarantined subscribers are never part of a broadcast audience
+        with self._lock:
+            self._ensure()
+            return self.evaluate(expression) - self._flags["quarantined"]
+
+    def count(self, expression):
+        return len(self.targetable(expression))
+
+    def breakdown(self, expression, area_ids=None):
+        # Recipient counts per segment and per carrier, without the suppressed
+        # numbers fan-out skips
+        with self._lock:
+            audience = self.targetable(expression) - self._flags["suppressed"]
+            if area_ids is not None:
+                audience = audience & area_ids
+            segments = {value: len(audience & bitmap) for value, bitmap in self._values[SEGMENT_ATTRIBUTE].items()}
+            carriers = {carrier: len(audience & bitmap) for carrier, bitmap in self._carriers.items()}
+            return segments, {carrier: count for carrier, count in carriers.items() if count}
+
+    def segments(self, expression, area_ids=None):
+        with self._lock:
+            audience = self.targetable(expression)
+            if area_ids is not None:
+                audience = audience & area_ids
+            msisdns = self._msisdns
+            return {
+                value: array("q", [msisdns[i] for i in audience & bitmap])
+                for value, bitmap in self._values[SEGMENT_ATTRIBUTE].items()
+            }
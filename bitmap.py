@@ -0,0 +1,176 @@
+from array import array
+from bisect import bisect_left
+
+CONTAINER_SIZE = 1 << 16
+CONTAINER_BYTES = CONTAINER_SIZE // 8
+LOW_MASK = CONTAINER_SIZE - 1
+# Containers with more values than this are kept as a 65536-bit int
+ARRAY_LIMIT = 4096
+
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def _to_bits(values):
+    data = bytearray(CONTAINER_BYTES)
+    for value in values:
+        data[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(data, "little")
+
+
+def _to_array(bits):
+    values = array("H")
+    for offset, byte in enumerate(bits.to_bytes(CONTAINER_BYTES, "little")):
+        if byte:
+            base = offset << 3
+            values.extend([base + bit for bit in _BYTE_BITS[byte]])
+    return values
+
+
+def _cardinality(container):
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _normalize(container):
+    if isinstance(container, int):
+        count = container.bit_count()
+        if count == 0:
+            return None
+        return _to_array(container) if count <= ARRAY_LIMIT else container
+    if not container:
+        return None
+    return _to_bits(container) if len(container) > ARRAY_LIMIT else container
+
+
+def _filter(values, bits, keep):
+    data = bits.to_bytes(CONTAINER_BYTES, "little")
+    return array("H", [v for v in values if bool(data[v >> 3] >> (v & 7) & 1) is keep])
+
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return _normalize(a & b)
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        return _normalize(_filter(a, b, True))
+    return _normalize(array("H", sorted(set(a).intersection(b))))
+
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int):
+        a = a if isinstance(a, int) else _to_bits(a)
+        b = b if isinstance(b, int) else _to_bits(b)
+        return _normalize(a | b)
+    return _normalize(array("H", sorted(set(a).union(b))))
+
+
+def _andnot(a, b):
+    if isinstance(a, int):
+        return _normalize(a & ~(b if isinstance(b, int) else _to_bits(b)))
+    if isinstance(b, int):
+        return _normalize(_filter(a, b, False))
+    return _normalize(array("H", sorted(set(a).difference(b))))
+
+
+class RoaringBitmap:
+    # Roaring-style compressed set of non-negative ints: values are split by
+    # their high 16 bits into containers that are either a sorted array('H')
+    # (sparse) or a 65536-bit int (dense)
+    __slots__ = ("_containers",)
+
+    def __init__(self, containers=None):
+        self._containers = containers if containers is not None else {}
+
+    @classmethod
+    def from_sorted(cls, values):
+        # values: a sorted sequence of distinct ints
+        containers = {}
+        start = 0
+        while start < len(values):
+            high = values[start] >> 16
+            end = bisect_left(values, (high + 1) << 16, start)
+            containers[high] = _normalize(array("H", [value & LOW_MASK for value in values[start:end]]))
+            start = end
+        return cls(containers)
+
+    def copy(self):
+        return RoaringBitmap(dict(self._containers))
+
+    def add(self, value):
+        high, low = value >> 16, value & LOW_MASK
+        container = self._containers.get(high)
+        if container is None:
+            self._containers[high] = array("H", [low])
+        elif isinstance(container, int):
+            self._containers[high] = container | (1 << low)
+        else:
+            position = bisect_left(container, low)
+            if position == len(container) or container[position] != low:
+                container = array("H", container)
+                container.insert(position, low)
+                self._containers[high] = _normalize(container)
+
+    def discard(self, value):
+        high, low = value >> 16, value & LOW_MASK
+        container = self._containers.get(high)
+        if container is None:
+            return
+        if isinstance(container, int):
+            container = _normalize(container & ~(1 << low))
+        else:
+            position = bisect_left(container, low)
+            if position == len(container) or container[position] != low:
+                return
+            container = array("H", container)
+            del container[position]
+            container = _normalize(container)
+        if container is None:
+            del self._containers[high]
+        else:
+            self._containers[high] = container
+
+    def __contains__(self, value):
+        container = self._containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & LOW_MASK
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self._containers.values())
+
+    def __bool__(self):
+        return bool(self._containers)
+
+    def __iter__(self):
+        for high in sorted(self._containers):
+            container = self._containers[high]
+            base = high << 16
+            for low in (_to_array(container) if isinstance(container, int) else container):
+                yield base | low
+
+    def __and__(self, other):
+        containers = {}
+        for high in self._containers.keys() & other._containers.keys():
+            container = _and(self._containers[high], other._containers[high])
+            if container is not None:
+                containers[high] = container
+        return RoaringBitmap(containers)
+
+    def __or__(self, other):
+        containers = dict(self._containers)
+        for high, container in other._containers.items():
+            containers[high] = _or(containers[high], container) if high in containers else container
+        return RoaringBitmap(containers)
+
+    def __sub__(self, other):
+        containers = {}
+        for high, container in self._containers.items():
+            if high in other._containers:
+                container = _andnot(container, other._containers[high])
+            if container is not None:
+                containers[high] = container
+        return RoaringBitmap(containers)
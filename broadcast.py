@@ -0,0 +1,207 @@
+import threading
+import time
+import uuid
+from array import array
+from msisdn import normalize_msisdn
+from quarantine import DELIVERED_STATUSES, FAILED_STATUSES
+from tenancy import per_app, tenant_name
+from metrics import time_to_alert
+
+ACCEPTED_STATUS = "Success"
+BROADCAST_RETENTION = 24 * 3600
+ALERT_TTL = 30 * 60
+COALESCE_WINDOW = 5 * 60
+
+
+class Broadcast:
+    def __init__(self, message, ttl=ALERT_TTL, incident=None, tenant=None):
+        self.id = uuid.uuid4().hex
+        self.tenant = tenant
+        self.message = message
+        self.incident = incident
+        self.superseded_by = None
+        self.created = time.time()
+        self.expires_at = self.created + ttl
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.expired = 0
+        self.superseded = 0
+        self.escalated = False
+        self.last_sent = None
+        # Time-to-alert trace: when each stage was first reached, and seconds
+        # from acceptance to every delivery report
+        self.stages = {"accepted": self.created}
+        self.deliveries = array('d')
+        self.trace_dirty = True
+        self.chunks_pending = 0
+        self.fanned_out = False
+        # Accepted by the provider but not yet reported delivered
+        self._undelivered = set()
+        self._lock = threading.Lock()
+
+    def delivery_ratio(self):
+        return self.delivered / self.sent if self.sent else 1.0
+
+    def throughput(self):
+        # Recipients accepted by the provider per second, up to the latest acceptance
+        if not self.sent or self.last_sent is None or self.last_sent <= self.created:
+            return 0.0
+        return self.sent / (self.last_sent - self.created)
+
+    def mark(self, stage, now=None):
+        if stage not in self.stages:
+            with self._lock:
+                self._mark(stage, now)
+
+    def _mark(self, stage, now=None):
+        # Caller holds _lock; only the first time a stage is reached counts
+        if stage in self.stages:
+            return
+        now = now or time.time()
+        self.stages[stage] = now
+        self.trace_dirty = True
+        time_to_alert.observe(now - self.created, self.tenant, stage)
+
+    def chunk_queued(self):
+        with self._lock:
+            self.chunks_pending += 1
+
+    def chunk_finished(self):
+        # A queued chunk was sent, failed or dropped as stale
+        with self._lock:
+            self.chunks_pending -= 1
+            if self.fanned_out and not self.chunks_pending:
+                self._mark("last_sent")
+
+    def fan_out_finished(self):
+        # Every chunk of the initial fan-out is queued; the last one to finish
+        # ends the send phase
+        with self._lock:
+            self.fanned_out = True
+            if not self.chunks_pending:
+                self._mark("last_sent")
+
+    def take_trace(self, clear=True):
+        # (stages, delivery seconds) copies; clear marks the trace as stored
+        with self._lock:
+            if clear:
+                self.trace_dirty = False
+            return dict(self.stages), array('d', self.deliveries)
+
+    def is_expired(self, now=None):
+        return (now or time.time()) >= self.expires_at
+
+    def is_stale(self, now=None):
+        return self.superseded_by is not None or self.is_expired(now)
+
+    def discard_stale(self, count):
+        # Accounts for a chunk that must no longer be sent and returns True
+        if self.superseded_by is not None:
+            with self._lock:
+                self.superseded += count
+            return True
+        if self.is_expired():
+            with self._lock:
+                self.expired += count
+            return True
+        return False
+
+    def undelivered(self):
+        with self._lock:
+            return list(self._undelivered)
+
+    def counters(self):
+        return {
+            "id": self.id,
+            "sent": self.sent,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "expired": self.expired,
+            "superseded": self.superseded,
+            "incident": self.incident,
+            "superseded_by": self.superseded_by,
+            "undelivered": len(self._undelivered),
+            "escalated": self.escalated,
+            "expires_at": self.expires_at,
+        }
+
+
+class BroadcastRegistry:
+    def __init__(self):
+        self._broadcasts = {}
+        self._messages = {}
+        self._incidents = {}
+        self._lock = threading.Lock()
+
+    def start(self, message, ttl=ALERT_TTL, incident=None):
+        broadcast = Broadcast(message, ttl, incident, tenant_name())
+        with self._lock:
+            self._prune()
+            self._broadcasts[broadcast.id] = broadcast
+            if incident:
+                # Undispatched chunks of the previous update are dropped; this
+                # broadcast reaches those recipients with the latest text instead
+                previous = self._incidents.get(incident)
+                if previous is not None and broadcast.created - previous.created < COALESCE_WINDOW:
+                    previous.superseded_by = broadcast.id
+                self._incidents[incident] = broadcast
+        return broadcast
+
+    def get(self, broadcast_id):
+        return self._broadcasts.get(broadcast_id)
+
+    def all(self):
+        return list(self._broadcasts.values())
+
+    def active(self, now=None):
+        now = now or time.time()
+        return [b for b in list(self._broadcasts.values()) if b.expires_at > now]
+
+    def _prune(self):
+        cutoff = time.time() - BROADCAST_RETENTION
+        for broadcast_id in [k for k, b in self._broadcasts.items() if b.created < cutoff]:
+            del self._broadcasts[broadcast_id]
+        for message_id in [k for k, (b, _) in self._messages.items() if b.created < cutoff]:
+            del self._messages[message_id]
+        for incident in [k for k, b in self._incidents.items() if b.created < cutoff]:
+            del self._incidents[incident]
+
+    def record_response(self, broadcast, response):
+        if not isinstance(response, dict):
+            return
+        recipients = response.get("SMSMessageData", {}).get("Recipients", [])
+        accepted = [(r.get("messageId"), normalize_msisdn(r.get("number")))
+                    for r in recipients if r.get("status") == ACCEPTED_STATUS]
+        with broadcast._lock:
+            if accepted:
+                broadcast.last_sent = time.time()
+            for message_id, msisdn in accepted:
+                if msisdn not in broadcast._undelivered:
+                    broadcast._undelivered.add(msisdn)
+                    broadcast.sent += 1
+                self._messages[message_id] = (broadcast, msisdn)
+
+    def delivery_report(self, message_id, status):
+        entry = self._messages.get(message_id)
+        if entry is None:
+            return None
+        broadcast, msisdn = entry
+        with broadcast._lock:
+            if status in DELIVERED_STATUSES:
+                if msisdn in broadcast._undelivered:
+                    broadcast._undelivered.discard(msisdn)
+                    broadcast.delivered += 1
+                    latency = time.time() - broadcast.created
+                    broadcast.deliveries.append(latency)
+                    broadcast.trace_dirty = True
+                    time_to_alert.observe(latency, broadcast.tenant, "delivered")
+            elif status in FAILED_STATUSES:
+                broadcast.failed += 1
+            else:
+                return broadcast
+            self._messages.pop(message_id, None)
+        return broadcast
+
+
+broadcasts = per_app("broadcasts", BroadcastRegistry)
@@ -0,0 +1,88 @@
+from array import array
+from msisdn import NATIONAL_LENGTH
+
+# National number prefixes (after 255) of each operator's mobile ranges
+CARRIER_PREFIXES = {
+    "Vodacom": ("74", "75", "76"),
+    "Airtel": ("68", "69", "78"),
+    "Tigo": ("65", "67", "71", "77"),
+    "Halotel": ("61", "62"),
+    "TTCL": ("73",),
+}
+
+CLASSIFY_UNKNOWN = 'UPDATE subscribers SET carrier = carrier_of(msisdn) WHERE carrier IS NULL'
+
+
+class PrefixTrie:
+    def __init__(self):
+        self._root = {}
+        self.depth = 0
+
+    def insert(self, prefix, value):
+        node = self._root
+        for digit in prefix:
+            node = node.setdefault(digit, {})
+        node[None] = value
+        self.depth = max(self.depth, len(prefix))
+
+    def match(self, digits):
+        # Value of the longest prefix of digits, None if nothing matches
+        node = self._root
+        value = node.get(None)
+        for digit in digits:
+            node = node.get(digit)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+    def compile(self):
+        return CarrierTable([self.match(str(prefix).zfill(self.depth)) for prefix in range(10 ** self.depth)],
+                            self.depth)
+
+
+class CarrierTable:
+    # The trie flattened to one slot per depth-digit prefix, so classifying
+    # an msisdn is an integer division and a list index
+    def __init__(self, table, depth):
+        self._table = table
+        self._divisor = 10 ** (NATIONAL_LENGTH - depth)
+        self._modulus = 10 ** NATIONAL_LENGTH
+
+    def __call__(self, msisdn):
+        return self._table[msisdn % self._modulus // self._divisor]
+
+    def partition(self, segments, suppressed=()):
+        # {carrier: array of msisdns}, keeping segment order within each carrier
+        carriers = {}
+        appenders = {}
+        table, divisor, modulus = self._table, self._divisor, self._modulus
+        for numbers in segments.values():
+            for msisdn in numbers:
+                if msisdn in suppressed:
+                    continue
+                carrier = table[msisdn % modulus // divisor]
+                append = appenders.get(carrier)
+                if append is None:
+                    carriers[carrier] = array('q')
+                    append = appenders[carrier] = carriers[carrier].append
+                append(msisdn)
+        return carriers
+
+
+def build_carrier_table(prefixes=CARRIER_PREFIXES):
+    trie = PrefixTrie()
+    for carrier, carrier_prefixes in prefixes.items():
+        for prefix in carrier_prefixes:
+            trie.insert(prefix, carrier)
+    return trie.compile()
+
+
+carrier_of = build_carrier_table()
+
+
+def classify_unknown(engine):
+    # Backfills carrier for rows stored before it was classified on subscribe
+    with engine.begin() as conn:
+        conn.connection.create_function("carrier_of", 1, carrier_of, deterministic=True)
+        return conn.exec_driver_sql(CLASSIFY_UNKNOWN).rowcount
@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from model import db
+from metrics import db_query_latency
+
+BUSY_TIMEOUT = 5
+SCAN_BATCH = 5000
+
+BUMP_DATA_VERSION = ('INSERT INTO data_version (id, version) VALUES (0, 1) '
+                     'ON CONFLICT(id) DO UPDATE SET version = version + 1 RETURNING version')
+SELECT_DATA_VERSION = 'SELECT version FROM data_version WHERE id = 0'
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Read-only connections can't switch journal mode; they inherit WAL from the file
+READER_PRAGMAS = SQLITE_PRAGMAS[2:] + ("PRAGMA query_only=ON",)
+
+ENGINE_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 10,
+    "max_overflow": 20,
+    "connect_args": {"timeout": BUSY_TIMEOUT, "check_same_thread": False},
+}
+
+
+_pinned = threading.local()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    db_query_latency.observe(time.perf_counter() - context.query_started, "statement")
+
+
+def timed_scan(cursor, sql, params):
+    # Yields row batches, recording only the time spent inside SQLite
+    started = time.perf_counter()
+    cursor.execute(sql, params)
+    elapsed = time.perf_counter() - started
+    while True:
+        started = time.perf_counter()
+        rows = cursor.fetchmany(SCAN_BATCH)
+        elapsed += time.perf_counter() - started
+        if not rows:
+            break
+        yield rows
+    db_query_latency.observe(elapsed, "scan")
+
+
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+set_sqlite_pragmas = partial(set_pragmas, SQLITE_PRAGMAS)
+
+
+def create_pooled_engine(path, pragmas=SQLITE_PRAGMAS, read_only=False, attach=None):
+    # attach: {schema: path} opened read-only on every connection
+    mode = "ro" if read_only else "rwc"
+    engine = create_engine(
+        f"sqlite:///file:{path}?mode={mode}&uri=true",
+        poolclass=QueuePool,
+        pool_size=ENGINE_OPTIONS["pool_size"],
+        max_overflow=ENGINE_OPTIONS["max_overflow"],
+        connect_args=ENGINE_OPTIONS["connect_args"],
+    )
+    statements = pragmas + tuple(f"ATTACH DATABASE 'file:{attached}?mode=ro' AS {schema}"
+                                 for schema, attached in (attach or {}).items())
+    event.listen(engine, "connect", partial(set_pragmas, statements))
+    return engine
+
+
+def create_reader_engine(url):
+    # Separate read-only pool for broadcast scans, so they never queue
+    # behind (or hold up) the /subscribe write path
+    return create_pooled_engine(url.database, READER_PRAGMAS, read_only=True)
+
+
+def init_database(app):
+    # Routes, fan-out, workers and CLI commands all share this one pooled engine
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", ENGINE_OPTIONS)
+    db.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+        app.extensions["reader_engine"] = create_reader_engine(db.engine.url)
+
+
+@contextmanager
+def read_snapshot():
+    # Pins one WAL snapshot per database for this thread: every read made
+    # through reader_connection() inside the block sees the same committed
+    # state, whatever /subscribe writes in the meantime. Nested blocks reuse
+    # the outer snapshot.
+    if getattr(_pinned, "cons", None) is not None:
+        yield
+        return
+    _pinned.cons = {}
+    try:
+        yield
+    finally:
+        cons, _pinned.cons = _pinned.cons, None
+        for con in cons.values():
+            try:
+                con.rollback()
+            finally:
+                con.close()
+
+
+@contextmanager
+def reader_connection(engine):
+    # The pinned snapshot connection for engine inside read_snapshot(),
+    # otherwise a pooled connection for the duration of the block
+    cons = getattr(_pinned, "cons", None)
+    if cons is not None:
+        con = cons.get(engine)
+        if con is None:
+            con = engine.raw_connection()
+            con.cursor().execute("BEGIN")
+            cons[engine] = con
+        yield con
+        return
+    con = engine.raw_connection()
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+def bump_data_version():
+    # Makes every process serving this database reload its in-memory indexes;
+    # returns the new version
+    with db.engine.begin() as conn:
+        return conn.exec_driver_sql(BUMP_DATA_VERSION).scalar()
+
+
+def data_version():
+    # One indexed row, read through the pinned snapshot when there is one
+    with reader_connection(current_app.extensions["reader_engine"]) as con:
+        row = con.cursor().execute(SELECT_DATA_VERSION).fetchone()
+    return row[0] if row else 0
+
+
+def query_rows(sql, params=()):
+    # Streams rows for bulk loaders over a read-only pooled connection
+    with reader_connection(current_app.extensions["reader_engine"]) as con:
+        for rows in timed_scan(con.cursor(), sql, params):
+            yield from rows
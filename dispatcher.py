@@ -0,0 +1,201 @@
+import logging
+import threading
+from collections import deque
+from flask import current_app
+from ratelimit import TokenBucket
+from senders import sender_pool
+from logs import log_failure
+from profiler import profiler
+
+DISPATCH_WORKERS = 4
+DISPATCH_QUEUE_SIZE = 64
+# Recipients a weight-1 tenant may send per round before the next tenant's turn
+FAIR_SHARE_QUANTUM = 1000
+
+log = logging.getLogger("dharura.dispatcher")
+
+
+class CarrierLane:
+    def __init__(self, carrier, rate=None):
+        self.carrier = carrier
+        self.chunks = deque()
+        self.bucket = TokenBucket(rate) if rate else None
+
+
+class TenantQueue:
+    def __init__(self, app, senders):
+        self.app = app
+        # The tenant's SenderPool, checked before a chunk is handed to a worker
+        self.sender_pool = senders
+        self.weight = app.config.get("FAIR_SHARE_WEIGHT") or 1
+        rate = app.config.get("SMS_RATE_BUDGET")
+        self.bucket = TokenBucket(rate) if rate else None
+        self.deficit = 0
+        # One worker per provisioned sender keeps every sender's bucket busy
+        self.senders = len(app.config.get("SMS_SENDERS") or ()) or 1
+        self.carrier_rates = app.config.get("CARRIER_RATES") or {}
+        self.lanes = {}
+        # Lanes with queued chunks, served in turn so carriers interleave
+        self.active = deque()
+        self.queued = 0
+
+    def lane(self, carrier):
+        lane = self.lanes.get(carrier)
+        if lane is None:
+            lane = self.lanes[carrier] = CarrierLane(carrier, self.carrier_rates.get(carrier))
+        return lane
+
+
+class ChunkDispatcher:
+    def __init__(self, send, workers=DISPATCH_WORKERS, maxsize=DISPATCH_QUEUE_SIZE, quantum=FAIR_SHARE_QUANTUM):
+        # One queue per tenant app, served by deficit round robin so a tenant's
+        # million-recipient alert can't starve another tenant's broadcast.
+        # Within a tenant, each carrier has its own lane and rate, so a slow
+        # operator only holds up its own recipients. send(broadcast, chunk,
+        # sender) gets a sender already reserved from the tenant's pool.
+        self._send = send
+        self.workers = workers
+        self.maxsize = maxsize
+        self.quantum = quantum
+        self._tenants = {}
+        self._active = deque()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._threads = []
+
+    def _start(self):
+        workers = max(self.workers, sum(tenant.senders for tenant in self._tenants.values()))
+        while len(self._threads) < workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def depth(self):
+        with self._condition:
+            return sum(tenant.queued for tenant in self._tenants.values())
+
+    def submit(self, broadcast, chunk, carrier=None):
+        if broadcast.discard_stale(len(chunk)):
+            return False
+        app = current_app._get_current_object()
+        with self._condition:
+            tenant = self._tenants.get(app)
+            if tenant is None:
+                tenant = self._tenants[app] = TenantQueue(app, sender_pool._get_current_object())
+            self._start()
+            lane = tenant.lane(carrier)
+            # Back-pressure is per carrier lane, so only that lane's producer waits
+            while len(lane.chunks) >= self.maxsize:
+                self._condition.wait()
+            if not tenant.queued:
+                self._active.append(tenant)
+            if not lane.chunks:
+                tenant.active.append(lane)
+            lane.chunks.append((broadcast, chunk))
+            broadcast.chunk_queued()
+            tenant.queued += 1
+            self._pending += 1
+            self._condition.notify_all()
+        return True
+
+    def join(self):
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+
+    def _ready_lane(self, tenant):
+        # (lane whose carrier can take its next chunk now, None) or (None, seconds to wait)
+        wait = None
+        checked = 0
+        while checked < len(tenant.active):
+            lane = tenant.active[0]
+            broadcast, chunk = lane.chunks[0]
+            # Expired or superseded chunks are dropped without a provider call
+            if broadcast.discard_stale(len(chunk)):
+                self._pop(tenant, lane)
+                broadcast.chunk_finished()
+                self._done()
+                continue
+            delay = lane.bucket.wait_time(len(chunk)) if lane.bucket else 0
+            if not delay:
+                return lane, None
+            wait = delay if wait is None else min(wait, delay)
+            tenant.active.rotate(-1)
+            checked += 1
+        return None, wait
+
+    def _next(self):
+        with self._condition:
+            while True:
+                wait = None
+                retry = False
+                for _ in range(len(self._active)):
+                    tenant = self._active[0]
+                    lane, delay = self._ready_lane(tenant)
+                    if lane is None:
+                        if not tenant.queued:
+                            # Everything left was stale; the tenant is gone from the ring
+                            retry = True
+                            break
+                        wait = delay if wait is None else min(wait, delay)
+                        self._active.rotate(-1)
+                        continue
+                    broadcast, chunk = lane.chunks[0]
+                    if tenant.deficit < len(chunk):
+                        tenant.deficit += self.quantum * tenant.weight
+                        self._active.rotate(-1)
+                        retry = True
+                        continue
+                    delay = tenant.bucket.wait_time(len(chunk)) if tenant.bucket else 0
+                    sender = None
+                    if not delay:
+                        # Reserved here rather than waited for in the worker, so
+                        # a throttled sender never holds a shared worker asleep
+                        sender, delay = tenant.sender_pool.try_acquire(len(chunk))
+                    if delay:
+                        # Over its rate budget or its senders' rates; the other tenants go meanwhile
+                        wait = delay if wait is None else min(wait, delay)
+                        self._active.rotate(-1)
+                        continue
+                    for bucket in (tenant.bucket, lane.bucket):
+                        if bucket:
+                            bucket.take(len(chunk))
+                    tenant.deficit -= len(chunk)
+                    self._pop(tenant, lane)
+                    return tenant.app, broadcast, chunk, sender
+                if not retry:
+                    self._condition.wait(wait)
+
+    def _pop(self, tenant, lane):
+        # lane is at the front of tenant.active
+        lane.chunks.popleft()
+        tenant.queued -= 1
+        if lane.chunks:
+            tenant.active.rotate(-1)
+        else:
+            tenant.active.popleft()
+        if not tenant.queued:
+            self._active.remove(tenant)
+            tenant.deficit = 0
+        self._condition.notify_all()
+
+    def _done(self):
+        with self._condition:
+            self._pending -= 1
+            if not self._pending:
+                self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            app, broadcast, chunk, sender = self._next()
+            profiled = profiler.begin("broadcast")
+            try:
+                with app.app_context():
+                    self._send(broadcast, chunk, sender)
+            except Exception:
+                log_failure(log, "chunk_send_failed", broadcast=broadcast.id, recipients=len(chunk))
+            finally:
+                if profiled:
+                    profiler.end()
+                broadcast.chunk_finished()
+                self._done()
@@ -0,0 +1,40 @@
+import math
+import threading
+
+ESCALATION_RATIO = 0.9
+ESCALATION_DEADLINE = 600
+CHANNELS = ("sms", "voice")
+
+
+class EscalationPolicy:
+    def __init__(self, ratio=ESCALATION_RATIO, deadline=ESCALATION_DEADLINE, channel="sms"):
+        if channel not in CHANNELS:
+            raise ValueError(f"Unknown escalation channel: {channel}")
+        if not 0 <= ratio <= 1:
+            raise ValueError("Escalation ratio must be between 0 and 1")
+        if not (deadline > 0 and math.isfinite(deadline)):
+            raise ValueError("Escalation deadline must be a positive number of seconds")
+        self.ratio = ratio
+        self.deadline = deadline
+        self.channel = channel
+
+
+def watch(broadcast, policy, retarget):
+    # retarget(broadcast, msisdns, channel) is called once, off the request thread
+    timer = threading.Timer(policy.deadline, check, (broadcast, policy, retarget))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def check(broadcast, policy, retarget):
+    if broadcast.escalated or broadcast.superseded_by is not None or broadcast.is_expired():
+        return False
+    if broadcast.delivery_ratio() >= policy.ratio:
+        return False
+    undelivered = broadcast.undelivered()
+    if not undelivered:
+        return False
+    broadcast.escalated = True
+    retarget(broadcast, undelivered, policy.channel)
+    return True
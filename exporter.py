@@ -0,0 +1,57 @@
+import json
+import zlib
+from msisdn import msisdn_to_e164
+
+PAGE_SIZE = 5000
+
+SELECT_PAGE = ('SELECT id, msisdn, occupation, campus, language, hostel, faculty, zone, latitude, longitude, '
+               'carrier FROM subscribers '
+               'WHERE id > ? ORDER BY id LIMIT ?')
+
+
+def subscriber_pages(engine, page_size=PAGE_SIZE):
+    # Keyset pagination on the primary key, one short read per page
+    last_id = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(SELECT_PAGE, (last_id, page_size)).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def export_ndjson(engines, page_size=PAGE_SIZE):
+    # One engine per shard; ids are mapped to the same global ids the indexes use
+    for shard, engine in enumerate(engines):
+        for rows in subscriber_pages(engine, page_size):
+            yield _ndjson(rows, len(engines), shard)
+
+
+def _ndjson(rows, shards, shard):
+    return "".join(
+        json.dumps({
+            "id": subscriber_id * shards + shard,
+            "msisdn": msisdn_to_e164(msisdn),
+            "occupation": occupation,
+            "campus": campus,
+            "language": language,
+            "hostel": hostel,
+            "faculty": faculty,
+            "zone": zone,
+            "latitude": latitude,
+            "longitude": longitude,
+            "carrier": carrier,
+        }) + "\n"
+        for subscriber_id, msisdn, occupation, campus, language, hostel, faculty, zone, latitude, longitude, carrier
+        in rows
+    ).encode()
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
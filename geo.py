@@ -0,0 +1,233 @@
+import json
+import math
+import threading
+from array import array
+from bitmap import RoaringBitmap
+
+# Grid cells of 0.01 degrees, roughly 1.1km on a side near the equator
+CELL_DEGREES = 0.01
+EARTH_RADIUS = 6371008.8
+MAX_RADIUS = 500000.0
+# Cell edges along a parallel bow slightly outside the great circle through
+# their corners; a metre of slack covers that at any cell size used here
+CELL_SLACK = 1.0
+# Points closer than this to a polygon edge count as on the edge
+EDGE_EPSILON = 1e-9
+# Widens a circle's bounding box against rounding, in degrees (about 10cm)
+BOX_MARGIN = 1e-6
+
+
+def cell_of(lat, lon):
+    return math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def point_in_polygon(lat, lon, polygon):
+    # Ray casting on (lat, lon) vertices
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+
+def circle_box(lat, lon, radius):
+    # (min_lat, max_lat, min_lon, max_lon) of the spherical cap, on the same
+    # sphere as haversine. The cap is widest at latitude asin(sin(lat) / cos(r)),
+    # where it spans asin(sin(r) / cos(lat)) of longitude either side.
+    angle = radius / EARTH_RADIUS
+    dlat = math.degrees(angle) + BOX_MARGIN
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    sin_angle, cos_lat = math.sin(angle), math.cos(math.radians(lat))
+    if sin_angle >= cos_lat or min_lat == -90.0 or max_lat == 90.0:
+        # The cap reaches a pole and covers every longitude
+        return min_lat, max_lat, -180.0, 180.0
+    dlon = math.degrees(math.asin(sin_angle / cos_lat)) + BOX_MARGIN
+    if lon - dlon < -180.0 or lon + dlon > 180.0:
+        # Crosses the antimeridian
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, lon - dlon, lon + dlon
+
+
+def circle_cells(lat, lon, radius):
+    # Returns cell -> whether the cell lies wholly inside the circle. A
+    # spherical cap is convex, so a cell is inside once its four corners are;
+    # neighbouring cells share corners, so each is measured once.
+    corners = {}
+
+    def corner_inside(row, col):
+        inside = corners.get((row, col))
+        if inside is None:
+            inside = corners[row, col] = (
+                haversine(lat, lon, row * CELL_DEGREES, col * CELL_DEGREES) <= radius - CELL_SLACK)
+        return inside
+
+    def cell_inside(cell):
+        row, col = cell
+        return (corner_inside(row, col) and corner_inside(row + 1, col)
+                and corner_inside(row, col + 1) and corner_inside(row + 1, col + 1))
+    return cell_inside
+
+
+def edge_cells(polygon):
+    # Every cell a polygon edge passes through, walked one row of cells at a
+    # time. The other cells lie wholly inside or wholly outside.
+    cells = set()
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        (lat_a, lon_a), (lat_b, lon_b) = polygon[j], polygon[i]
+        j = i
+        low_row = math.floor((min(lat_a, lat_b) - EDGE_EPSILON) / CELL_DEGREES)
+        high_row = math.floor((max(lat_a, lat_b) + EDGE_EPSILON) / CELL_DEGREES)
+        for row in range(low_row, high_row + 1):
+            if lat_a == lat_b:
+                lons = (lon_a, lon_b)
+            else:
+                # Where the edge enters and leaves this row
+                lats = (max(row * CELL_DEGREES, min(lat_a, lat_b)), min((row + 1) * CELL_DEGREES, max(lat_a, lat_b)))
+                lons = [lon_a + (lat - lat_a) * (lon_b - lon_a) / (lat_b - lat_a) for lat in lats]
+            low_col = math.floor((min(lons) - EDGE_EPSILON) / CELL_DEGREES)
+            high_col = math.floor((max(lons) + EDGE_EPSILON) / CELL_DEGREES)
+            cells.update((row, col) for col in range(low_col, high_col + 1))
+    return cells
+
+
+def parse_location(lat, lon):
+    lat, lon = float(lat), float(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("Coordinates out of range")
+    return lat, lon
+
+
+def parse_area(lat=None, lon=None, radius=None, polygon=None):
+    # Returns {"lat", "lon", "radius"} or {"polygon"}, None when untargeted
+    if polygon:
+        points = json.loads(polygon) if isinstance(polygon, str) else polygon
+        if not isinstance(points, list) or len(points) < 3:
+            raise ValueError("A polygon needs at least three points")
+        return {"polygon": [list(parse_location(*point)) for point in points]}
+    if lat is None and lon is None and radius is None:
+        return None
+    if lat is None or lon is None or radius is None:
+        raise ValueError("lat, lon and radius go together")
+    lat, lon = parse_location(lat, lon)
+    radius = float(radius)
+    if not 0 < radius <= MAX_RADIUS:
+        raise ValueError("Radius out of range")
+    return {"lat": lat, "lon": lon, "radius": radius}
+
+
+class GridIndex:
+    def __init__(self, loader, data_version=None):
+        # loader() yields (id, latitude, longitude) for located subscribers;
+        # data_version() changes when another process rewrites them in bulk
+        self._loader = loader
+        self._data_version = data_version
+        self._loaded_version = None
+        self._cells = None
+        self._located = {}
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        with self._lock:
+            self._cells = None
+            self._located = {}
+
+    def _ensure(self):
+        current = self._data_version() if self._data_version else None
+        if self._cells is not None and current == self._loaded_version:
+            return
+        self._cells = {}
+        self._located = {}
+        for subscriber_id, lat, lon in self._loader():
+            self._insert(subscriber_id, lat, lon)
+        self._loaded_version = current
+
+    def _insert(self, subscriber_id, lat, lon):
+        cell = cell_of(lat, lon)
+        entry = self._cells.get(cell)
+        if entry is None:
+            entry = self._cells[cell] = (array("q"), array("d"), array("d"))
+        entry[0].append(subscriber_id)
+        entry[1].append(lat)
+        entry[2].append(lon)
+        self._located[subscriber_id] = cell
+
+    def caught_up(self, version):
+        # This process moved the data version to version and already patched
+        # itself; only a change from elsewhere makes it reload
+        with self._lock:
+            if self._loaded_version is not None and self._loaded_version == version - 1:
+                self._loaded_version = version
+
+    def add(self, subscriber_id, lat, lon):
+        with self._lock:
+            if self._cells is not None:
+                self._insert(subscriber_id, lat, lon)
+
+    def remove(self, subscriber_id):
+        with self._lock:
+            if self._cells is None:
+                return
+            cell = self._located.pop(subscriber_id, None)
+            if cell is None:
+                return
+            ids, lats, lons = self._cells[cell]
+            position = ids.index(subscriber_id)
+            del ids[position], lats[position], lons[position]
+
+    def _candidates(self, min_lat, max_lat, min_lon, max_lon):
+        # (cell, (ids, lats, lons)) for the occupied cells overlapping the box
+        low_x, low_y = cell_of(min_lat, min_lon)
+        high_x, high_y = cell_of(max_lat, max_lon)
+        if (high_x - low_x + 1) * (high_y - low_y + 1) <= len(self._cells):
+            cells = ((x, y) for x in range(low_x, high_x + 1) for y in range(low_y, high_y + 1))
+        else:
+            cells = (cell for cell in list(self._cells)
+                     if low_x <= cell[0] <= high_x and low_y <= cell[1] <= high_y)
+        for cell in cells:
+            entry = self._cells.get(cell)
+            if entry is not None and entry[0]:
+                yield cell, entry
+
+    def query(self, area):
+        # Cells wholly inside the area are taken whole; only points in cells
+        # on its boundary are tested one by one
+        matches = []
+        with self._lock:
+            self._ensure()
+            if "polygon" in area:
+                polygon = area["polygon"]
+                lats = [point[0] for point in polygon]
+                lons = [point[1] for point in polygon]
+                boundary = edge_cells(polygon)
+                for cell, (ids, cell_lats, cell_lons) in self._candidates(min(lats), max(lats), min(lons), max(lons)):
+                    if cell in boundary:
+                        matches.extend(subscriber_id for subscriber_id, lat, lon in zip(ids, cell_lats, cell_lons)
+                                       if point_in_polygon(lat, lon, polygon))
+                    elif point_in_polygon((cell[0] + 0.5) * CELL_DEGREES, (cell[1] + 0.5) * CELL_DEGREES, polygon):
+                        matches.extend(ids)
+            else:
+                center_lat, center_lon, radius = area["lat"], area["lon"], area["radius"]
+                inside = circle_cells(center_lat, center_lon, radius)
+                box = circle_box(center_lat, center_lon, radius)
+                for cell, (ids, cell_lats, cell_lons) in self._candidates(*box):
+                    if inside(cell):
+                        matches.extend(ids)
+                    else:
+                        matches.extend(subscriber_id for subscriber_id, lat, lon in zip(ids, cell_lats, cell_lons)
+                                       if haversine(center_lat, center_lon, lat, lon) <= radius)
+        return RoaringBitmap.from_sorted(sorted(matches))
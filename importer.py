@@ -0,0 +1,147 @@
+import csv
+import json
+from itertools import islice
+from msisdn import normalize_msisdn
+from geo import parse_location
+from carriers import carrier_of
+
+BATCH_SIZE = 5000
+IMPORT_FORMATS = ("csv", "ndjson")
+EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+# Excel saves CSV with a byte order mark, which would stick to the first header
+IMPORT_ENCODING = "utf-8-sig"
+OCCUPATIONS = ("Staff", "Student")
+PHONE_FIELDS = ("phoneNumber", "msisdn")
+OCCUPATION_FIELDS = ("Occupation", "occupation")
+ATTRIBUTE_FIELDS = (
+    ("Campus", "campus"),
+    ("Language", "language"),
+    ("Hostel", "hostel"),
+    ("Faculty", "faculty"),
+    ("Zone", "zone"),
+)
+LOCATION_FIELDS = (("Latitude", "latitude"), ("Longitude", "longitude"))
+REJECT_FIELDS = ["line", "phoneNumber", "Occupation", "reason"]
+
+UPSERT_SUBSCRIBER = (
+    'INSERT INTO subscribers (msisdn, occupation, campus, language, hostel, faculty, zone, latitude, longitude, '
+    'carrier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT(msisdn) DO UPDATE SET occupation = excluded.occupation, '
+    'campus = COALESCE(excluded.campus, campus), language = COALESCE(excluded.language, language), '
+    'hostel = COALESCE(excluded.hostel, hostel), faculty = COALESCE(excluded.faculty, faculty), '
+    'zone = COALESCE(excluded.zone, zone), latitude = COALESCE(excluded.latitude, latitude), '
+    'longitude = COALESCE(excluded.longitude, longitude), carrier = excluded.carrier'
+)
+
+
+def detect_format(filename, fmt=None):
+    # Raises ValueError for anything other than CSV or NDJSON
+    if fmt:
+        if fmt.lower() not in IMPORT_FORMATS:
+            raise ValueError(f"Unknown import format: {fmt}")
+        return fmt.lower()
+    for extension, detected in EXTENSIONS.items():
+        if filename and filename.lower().endswith(extension):
+            return detected
+    raise ValueError("Import format not recognised from the file name; pass csv or ndjson")
+
+
+def read_rows(stream, fmt):
+    # Yields (line number, row dict or None for unparseable rows)
+    if fmt == "ndjson":
+        for line_no, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_no, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def _field(row, names):
+    for name in names:
+        value = row.get(name)
+        if value is not None:
+            return str(value)
+    return None
+
+
+def _attributes(row):
+    return tuple((_field(row, names) or "").strip() or None for names in ATTRIBUTE_FIELDS)
+
+
+def _location(row):
+    lat, lon = ((_field(row, names) or "").strip() for names in LOCATION_FIELDS)
+    if not lat and not lon:
+        return None, None
+    return parse_location(lat, lon)
+
+
+def validate_batch(batch, seen):
+    rows = [row or {} for _, row in batch]
+    phones = [_field(row, PHONE_FIELDS) for row in rows]
+    occupations = [(_field(row, OCCUPATION_FIELDS) or "").strip().title() for row in rows]
+    msisdns = list(map(normalize_msisdn, phones))
+
+    accepted = []
+    rejects = []
+    for (line_no, row), phone, msisdn, occupation in zip(batch, phones, msisdns, occupations):
+        if row is None:
+            reason = "Malformed Row"
+        elif msisdn is None:
+            reason = "MSISDN/Phone Number Not Clear"
+        elif occupation not in OCCUPATIONS:
+            reason = "Occupation Not Clear"
+        elif msisdn in seen:
+            reason = "Duplicate In File"
+        else:
+            try:
+                location = _location(row)
+            except (TypeError, ValueError):
+                reason = "Location Not Clear"
+            else:
+                seen.add(msisdn)
+                accepted.append((msisdn, occupation) + _attributes(row) + location + (carrier_of(msisdn),))
+                continue
+        rejects.append([line_no, phone, occupation, reason])
+    return accepted, rejects
+
+
+def upsert_batch(engine, rows):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(UPSERT_SUBSCRIBER, rows)
+
+
+def import_subscribers(write_batch, stream, fmt, reject_writer, batch_size=BATCH_SIZE):
+    # write_batch(rows) stores accepted rows, msisdn first. A file that stops
+    # decoding or parsing ends the import with "error" set in the summary;
+    # batches before it are already stored.
+    seen = set()
+    summary = {"rows": 0, "upserted": 0, "rejected": 0}
+    reject_writer.writerow(REJECT_FIELDS)
+
+    rows = read_rows(stream, fmt)
+    error = None
+    while error is None:
+        batch = []
+        try:
+            batch.extend(islice(rows, batch_size))
+        except (UnicodeDecodeError, csv.Error) as e:
+            error = summary["error"] = f"Unreadable after row {summary['rows'] + len(batch)}: {e}"
+        if not batch:
+            break
+        accepted, rejects = validate_batch(batch, seen)
+        if accepted:
+            write_batch(accepted)
+        reject_writer.writerows(rejects)
+
+        summary["rows"] += len(batch)
+        summary["upserted"] += len(accepted)
+        summary["rejected"] += len(rejects)
+    return summary
@@ -0,0 +1,84 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from metrics import Counter, registry
+
+# Fraction of high-volume success events that are logged; failures always are
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = 10000
+
+log_dropped = registry.register(Counter(
+    "dharura_log_records_dropped_total", "Log records dropped because the log queue was full."))
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name,
+                 "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # The calling thread only enqueues; the JSON is built and written on the
+    # listener thread. A full queue drops the record rather than stall a sender.
+    def prepare(self, record):
+        # Tracebacks can't cross threads, so only they are rendered here
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped.inc()
+
+
+def init_logging(stream=None):
+    # Routes the "dharura" loggers through one background writer; safe to call per app
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    logger = logging.getLogger("dharura")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(NonBlockingQueueHandler(records))
+    logger.propagate = False
+
+
+def log_event(logger, level, event, exc_info=None, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def log_failure(logger, event, exc_info=True, **fields):
+    log_event(logger, logging.ERROR, event, exc_info, **fields)
+
+
+def log_success(logger, event, **fields):
+    # Sampled before a record is even built, so logging cost doesn't grow with
+    # send volume. sample_rate lets a reader scale counts back up.
+    if random.random() < LOG_SAMPLE_RATE:
+        log_event(logger, logging.INFO, event, sample_rate=LOG_SAMPLE_RATE, **fields)
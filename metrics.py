@@ -0,0 +1,187 @@
+import itertools
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+ALERT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class _CellHolder:
+    # Lives in a thread's local storage; collected when the thread exits
+    __slots__ = ("__weakref__",)
+
+
+class _Metric:
+    # Every thread records into its own cells, so the hot path takes no lock;
+    # a scrape sums the cells of all threads. A thread's cells are folded into
+    # _retired once it exits, so short-lived threads don't pile up.
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def _cells(self):
+        cells = getattr(self._local, "cells", None)
+        if cells is None:
+            cells = self._local.cells = {}
+            holder = self._local.holder = _CellHolder()
+            key = next(self._keys)
+            with self._lock:
+                self._shards[key] = cells
+            weakref.finalize(holder, self._retire, key)
+        return cells
+
+    def _retire(self, key):
+        with self._lock:
+            _merge(self._retired, self._shards.pop(key, {}))
+
+    def _collect(self):
+        merged = {}
+        with self._lock:
+            _merge(merged, self._retired)
+            for cells in self._shards.values():
+                # dict.copy() runs under the GIL, so it never sees a half-inserted key
+                _merge(merged, cells.copy())
+        return merged
+
+
+def _merge(total, cells):
+    for key, values in cells.items():
+        current = total.get(key)
+        if current is None:
+            total[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                current[i] += value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        cells = self._cells()
+        cell = cells.get(labels)
+        if cell is None:
+            cell = cells[labels] = [0]
+        cell[0] += amount
+
+    def render(self):
+        for labels, (value,) in sorted(self._collect().items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        cells = self._cells()
+        cell = cells.get(labels)
+        if cell is None:
+            # One slot per bucket, then +Inf, then the sum
+            cell = cells[labels] = [0] * (len(self.buckets) + 2)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        for labels, cell in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell):
+                cumulative += count
+                le = (("le", _number(bound)),)
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(cell[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+
+
+class Gauge:
+    # Read at scrape time: collect() yields (label values, value)
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        for labels, value in self.collect():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_latency = registry.register(Histogram(
+    "dharura_request_duration_seconds", "HTTP request latency by endpoint.",
+    ("tenant", "endpoint", "method")))
+db_query_latency = registry.register(Histogram(
+    "dharura_db_query_duration_seconds", "Time spent executing database statements.",
+    ("kind",), QUERY_BUCKETS))
+provider_latency = registry.register(Histogram(
+    "dharura_provider_request_duration_seconds", "SMS provider call latency by sender.",
+    ("tenant", "sender")))
+provider_errors = registry.register(Counter(
+    "dharura_provider_errors_total", "SMS provider calls that raised, by sender.",
+    ("tenant", "sender")))
+time_to_alert = registry.register(Histogram(
+    "dharura_time_to_alert_seconds", "Seconds from an alert being accepted to each broadcast stage.",
+    ("tenant", "stage"), ALERT_BUCKETS))
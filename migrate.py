@@ -0,0 +1,116 @@
+import sqlite3
+from sqlalchemy.schema import CreateIndex, CreateTable
+from model import SubscriberModel, SubscriberStatsModel, db
+from msisdn import normalize_msisdn
+from carriers import classify_unknown
+from database import BUSY_TIMEOUT, SCAN_BATCH
+
+SUBSCRIBER_TABLES = (SubscriberModel.__table__, SubscriberStatsModel.__table__)
+
+
+def table_columns(con, table):
+    # {name: declared type}, empty when the table doesn't exist
+    return {row[1]: row[2].upper() for row in con.execute(f'PRAGMA table_info("{table}")')}
+
+
+def add_missing_columns(con, table, dialect):
+    # SQLite can't add NOT NULL columns without a default, so added columns are nullable
+    existing = table_columns(con, table.name)
+    if not existing:
+        return []
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            con.execute(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=dialect)}')
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def rebuild_subscribers(con, dialect):
+    # Subscribers from before msisdn was an integer column: TEXT affinity
+    # never matches integer lookups, so the table is recreated and every row
+    # copied over normalized. Rows that can't be normalized, or that collide
+    # with an earlier row once normalized, are dropped.
+    table = SubscriberModel.__table__
+    con.execute('ALTER TABLE subscribers RENAME TO subscribers_old')
+    # Indexes and triggers follow the rename; the new table gets its own
+    for kind, name in con.execute("SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') "
+                                  "AND tbl_name = 'subscribers_old' AND name NOT LIKE 'sqlite_%'").fetchall():
+        con.execute(f'DROP {kind.upper()} "{name}"')
+    con.execute(str(CreateTable(table).compile(dialect=dialect)))
+    for index in table.indexes:
+        con.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+    names = [name for name in table_columns(con, "subscribers_old") if name in table.columns]
+    columns = ", ".join(f'"{name}"' for name in names)
+    insert = f'INSERT OR IGNORE INTO subscribers ({columns}) VALUES ({", ".join("?" * len(names))})'
+    position = names.index("msisdn")
+    total = copied = 0
+    rows = con.execute(f'SELECT {columns} FROM subscribers_old ORDER BY id')
+    while True:
+        batch = rows.fetchmany(SCAN_BATCH)
+        if not batch:
+            break
+        total += len(batch)
+        normalized = []
+        for row in batch:
+            msisdn = normalize_msisdn(row[position])
+            if msisdn is not None:
+                normalized.append(row[:position] + (msisdn,) + row[position + 1:])
+        copied += con.executemany(insert, normalized).rowcount
+    con.execute('DROP TABLE subscribers_old')
+    return copied, total - copied
+
+
+def normalize_stray_msisdns(con):
+    # Integer column, but rows written as text before normalization existed
+    rows = con.execute("SELECT id, msisdn FROM subscribers WHERE typeof(msisdn) != 'integer'").fetchall()
+    dropped = 0
+    for subscriber_id, raw in rows:
+        msisdn = normalize_msisdn(raw)
+        if msisdn is None or con.execute('SELECT 1 FROM subscribers WHERE msisdn = ?', (msisdn,)).fetchone():
+            con.execute('DELETE FROM subscribers WHERE id = ?', (subscriber_id,))
+            dropped += 1
+        else:
+            con.execute('UPDATE subscribers SET msisdn = ? WHERE id = ?', (msisdn, subscriber_id))
+    return len(rows) - dropped, dropped
+
+
+def migrate_engine(engine, tables):
+    # Idempotent, and one transaction per database: an interrupted rebuild
+    # rolls back to the old table. A current database costs a PRAGMA per table.
+    report = {"added": [], "normalized": 0, "dropped": 0, "classified": 0}
+    con = sqlite3.connect(engine.url.database, timeout=BUSY_TIMEOUT, isolation_level=None,
+                          uri=engine.url.query.get("uri") == "true")
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        for table in tables:
+            report["added"] += add_missing_columns(con, table, engine.dialect)
+        msisdn_type = table_columns(con, "subscribers").get("msisdn")
+        if msisdn_type is not None:
+            if "INT" in msisdn_type:
+                report["normalized"], report["dropped"] = normalize_stray_msisdns(con)
+            else:
+                report["normalized"], report["dropped"] = rebuild_subscribers(con, engine.dialect)
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    if msisdn_type is not None:
+        report["classified"] = classify_unknown(engine)
+    return report
+
+
+def migrate(subscriber_engines):
+    # The primary database gets every table, shards their subscriber tables
+    report = migrate_engine(db.engine, db.metadata.sorted_tables)
+    for engine in subscriber_engines:
+        if engine is not db.engine:
+            shard = migrate_engine(engine, SUBSCRIBER_TABLES)
+            report["added"] += shard["added"]
+            for key in ("normalized", "dropped", "classified"):
+                report[key] += shard[key]
+    return report
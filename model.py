@@ -1,3 +1,4 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_serialize import FlaskSerialize
 
@@ -9,10 +10,26 @@ class SubscriberModel(db.Model, fs_mixin):
     __tablename__ = "subscribers"
 
     id = db.Column(db.Integer, primary_key=True)
-    msisdn = db.Column(db.String(13), unique=True)
+    msisdn = db.Column(db.BigInteger, unique=True, index=True, nullable=False)
     occupation = db.Column(db.String(80))
+    campus = db.Column(db.String(80))
+    language = db.Column(db.String(80))
+    hostel = db.Column(db.String(80))
+    faculty = db.Column(db.String(80))
+    zone = db.Column(db.String(80))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    carrier = db.Column(db.String(20))
 
-    __fs_create_fields__ = __fs_update_fields__ = ['msisdn', 'occupation']
+    __fs_create_fields__ = __fs_update_fields__ = ['msisdn', 'occupation', 'campus', 'language', 'hostel',
+                                                   'faculty', 'zone', 'latitude', 'longitude', 'carrier']
+
+
+class SubscriberStatsModel(db.Model):
+    __tablename__ = "subscriber_stats"
+
+    segment = db.Column(db.String(80), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
 
 
 class EmergencyModel(db.Model):
@@ -23,3 +40,66 @@ class EmergencyModel(db.Model):
     description = db.Column(db.String())
     date_reported = db.Column(db.String(80))
 
+
+
+class DataVersionModel(db.Model):
+    # One row, bumped by every bulk change to subscribers or their flags
+    __tablename__ = "data_version"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+
+class SuppressionModel(db.Model):
+    __tablename__ = "suppressions"
+
+    msisdn = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    reason = db.Column(db.String(40))
+    date_suppressed = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DeliveryHealthModel(db.Model):
+    __tablename__ = "delivery_health"
+
+    msisdn = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    failures = db.Column(db.Integer, default=0, nullable=False)
+    quarantined = db.Column(db.Boolean, default=False, nullable=False, index=True)
+    last_failure = db.Column(db.DateTime)
+    last_probe = db.Column(db.DateTime)
+
+
+class ScheduledAlertModel(db.Model):
+    __tablename__ = "scheduled_alerts"
+
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(80))
+    description = db.Column(db.String())
+    critical = db.Column(db.Boolean, default=False, nullable=False)
+    ttl = db.Column(db.Integer)
+    incident = db.Column(db.String(80))
+    audience = db.Column(db.String())
+    area = db.Column(db.String())
+    # Escalation policy; NULL falls back to the defaults
+    escalate_ratio = db.Column(db.Float)
+    escalate_after = db.Column(db.Float)
+    escalate_via = db.Column(db.String(10))
+    due_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), default="pending", nullable=False, index=True)
+
+
+class BroadcastTraceModel(db.Model):
+    __tablename__ = "broadcast_traces"
+
+    broadcast_id = db.Column(db.String(32), primary_key=True)
+    incident = db.Column(db.String(80))
+    release = db.Column(db.String(80), index=True)
+    accepted_at = db.Column(db.DateTime, nullable=False, index=True)
+    # Seconds after accepted_at
+    resolved = db.Column(db.Float)
+    first_sent = db.Column(db.Float)
+    last_sent = db.Column(db.Float)
+    recipients = db.Column(db.Integer, default=0, nullable=False)
+    delivered = db.Column(db.Integer, default=0, nullable=False)
+    delivery_p50 = db.Column(db.Float)
+    delivery_p95 = db.Column(db.Float)
+    delivery_p99 = db.Column(db.Float)
@@ -1,6 +1,26 @@
 import africastalking
-import sqlite3
-from model import SubscriberModel
+import logging
+import threading
+from functools import partial
+from flask import current_app
+from database import read_snapshot, data_version, bump_data_version
+from sharding import scan_subscribers, find_subscriber
+from msisdn import msisdn_to_e164, normalize_msisdn
+from suppression import suppression_list, blacklisted_numbers, unsubscribe, BLACKLISTED
+from quarantine import due_for_probe, mark_probed
+from voice import call_dispatcher, SEGMENT_PRIORITY, DEFAULT_PRIORITY
+from broadcast import broadcasts, ALERT_TTL, ACCEPTED_STATUS
+from dispatcher import ChunkDispatcher
+from snapshot import RecipientSnapshot, chunked
+from audience import BitmapIndex, ATTRIBUTES
+from geo import GridIndex
+from escalation import watch
+from tenancy import per_app, tenant_name
+from senders import sender_pool
+from carriers import carrier_of
+from metrics import Gauge, registry, provider_latency, provider_errors
+from logs import log_event, log_failure, log_success
+from profiler import profiler
 
 africastalking.initialize(
     username="sandbox",
@@ -9,45 +29,256 @@ africastalking.initialize(
 
 sms = africastalking.SMS
 
+CHUNK_SIZE = 1000
+PROBE_MESSAGE = "Dharura System Delivery Check"
+# A send that raises is retried once on another sender of the pool
+SEND_ATTEMPTS = 2
+
+log = logging.getLogger("dharura.send")
+
+
+def rejected_recipients(response):
+    recipients = response.get("SMSMessageData", {}).get("Recipients", []) if isinstance(response, dict) else []
+    return [{"number": r.get("number"), "status": r.get("status")}
+            for r in recipients if r.get("status") != ACCEPTED_STATUS]
+
+
+def provider_send(message, recipients, sender=None):
+    # Returns the provider response, None if every attempt failed. sender is
+    # one the caller already reserved for the first attempt.
+    tried = []
+    tenant = tenant_name()
+    for _ in range(min(SEND_ATTEMPTS, len(sender_pool))):
+        if sender is None:
+            sender = sender_pool.acquire(len(recipients), tried)
+        try:
+            with provider_latency.time(tenant, sender.id):
+                response = sms.send(message, recipients, sender.id)
+        except Exception:
+            log_failure(log, "provider_send_failed", tenant=tenant, sender=sender.id, recipients=len(recipients))
+            provider_errors.inc(tenant, sender.id)
+            sender_pool.failed(sender)
+            tried.append(sender)
+            sender = None
+            continue
+        sender_pool.report(sender, response, len(recipients))
+        rejected = rejected_recipients(response)
+        if rejected:
+            log_event(log, logging.WARNING, "provider_rejected", tenant=tenant, sender=sender.id,
+                      recipients=len(recipients), rejected=rejected)
+        else:
+            log_success(log, "provider_sent", tenant=tenant, sender=sender.id, recipients=len(recipients))
+        return response
+    return None
+
 
 def send_subscription_alert(recipient):
     message = "You Have Successfuly Subscribed To Dharura System"
-    sender = "32721"
-    recp = [recipient]
-    try:
-        response = sms.send(message, recp, sender)
-        print(response)
-    except Exception as e:
-        print(e)
+    provider_send(message, [recipient])
+
+
+SELECT_RECIPIENTS = ('SELECT s.msisdn, s.occupation FROM subscribers s '
+                     'LEFT JOIN delivery_health h ON h.msisdn = s.msisdn AND h.quarantined '
+                     'WHERE h.msisdn IS NULL;')
+# Ids are selected as id * :shards + :shard, see sharding.scan_subscribers
+SELECT_AUDIENCE = (f"SELECT id * :shards + :shard, msisdn, {', '.join(ATTRIBUTES)} "
+                   "FROM subscribers ORDER BY id;")
+SELECT_LOCATIONS = ('SELECT id * :shards + :shard, latitude, longitude FROM subscribers '
+                    'WHERE latitude IS NOT NULL AND longitude IS NOT NULL;')
+SELECT_FLAGGED = {
+    "suppressed": 'SELECT s.id * :shards + :shard FROM subscribers s JOIN suppressions p ON p.msisdn = s.msisdn;',
+    "quarantined": 'SELECT s.id * :shards + :shard FROM subscribers s JOIN delivery_health h '
+                   'ON h.msisdn = s.msisdn WHERE h.quarantined;',
+}
+
+
+def load_flagged(flag):
+    return [row[0] for row in scan_subscribers(SELECT_FLAGGED[flag])]
+
+
+recipient_snapshot = per_app("recipient_snapshot",
+                             lambda: RecipientSnapshot(partial(scan_subscribers, SELECT_RECIPIENTS), data_version))
+audience_index = per_app("audience_index",
+                         lambda: BitmapIndex(partial(scan_subscribers, SELECT_AUDIENCE, ordered=True), load_flagged,
+                                             data_version))
+geo_index = per_app("geo_index", lambda: GridIndex(partial(scan_subscribers, SELECT_LOCATIONS), data_version))
+
+
+def subscriber_added(subscriber_id, subscriber):
+    recipient_snapshot.add(subscriber.msisdn, subscriber.occupation)
+    audience_index.add(subscriber_id, subscriber.msisdn,
+                       {attribute: getattr(subscriber, attribute) for attribute in ATTRIBUTES})
+    if subscriber.latitude is not None and subscriber.longitude is not None:
+        geo_index.add(subscriber_id, subscriber.latitude, subscriber.longitude)
+
+
+def unsubscribe_subscriber(msisdn):
+    removed = unsubscribe(msisdn)
+    if removed is not None:
+        subscriber_id, occupation = removed
+        recipient_snapshot.remove(msisdn, occupation)
+        audience_index.remove(subscriber_id)
+        geo_index.remove(subscriber_id)
+    subscribers_patched()
+
+
+def subscribers_patched():
+    # A change this process already patched into its own indexes; the other
+    # processes pick it up through the data version
+    version = bump_data_version()
+    for cache in (suppression_list, recipient_snapshot, audience_index, geo_index):
+        cache.caught_up(version)
+
+
+def recipients_changed():
+    # Bulk changes (imports, quarantine, blacklisting) rebuild on next use, in
+    # this process and, through the data version, in every other one
+    bump_data_version()
+    recipient_snapshot.invalidate()
+    audience_index.invalidate()
+    geo_index.invalidate()
+
+
+def resolve_segments(audience=None, area=None):
+    if audience or area:
+        area_ids = geo_index.query(area) if area else None
+        return audience_index.segments(audience or "all", area_ids)
+    return recipient_snapshot.view()[1]
 
 
-def subscriber_pull(title, description):
-    # msisdns = SubscriberModel.query.order_by(SubscriberModel.msisdn.desc()).all()
-    # return SubscriberModel.fs_dict_list(msisdns)
-    con = sqlite3.connect('instance/sample_db.db')
-    cur = con.cursor()
-    nums = cur.execute('SELECT msisdn FROM subscribers;')
+def plan_segments(audience=None, area=None):
+    area_ids = geo_index.query(area) if area else None
+    return audience_index.breakdown(audience or "all", area_ids)
 
-    msisdns = cur.fetchall()
 
-    sender = "32721"
+def voice_escalate(broadcast, title, description, audience=None, area=None):
+    # Calls are resolved and queued off the request thread, so a critical
+    # alert's SMS fan-out never waits for call setup
+    app = current_app._get_current_object()
+    suppressed = suppression_list.numbers()
+    threading.Thread(target=queue_calls, daemon=True,
+                     args=(app, broadcast, f"Emergency. {title}. {description}", suppressed, audience, area)).start()
 
-    # for i in msisdns:
-    #     try:
-    #         message = f"{title}, {description}"
-    #         response = sms.send(message, i[0], sender)
-    #         print(response)
-    #     except Exception as e:
-    #         print(e)
 
+def queue_calls(app, broadcast, message, suppressed, audience=None, area=None):
+    # The call queue is bounded, so this waits on the voice workers instead
+    # of holding every pending call in memory. Segments are queued highest
+    # priority first, or a large low-priority segment would fill the queue
+    # ahead of them.
+    with app.app_context():
+        with read_snapshot():
+            segments = resolve_segments(audience, area)
+        order = sorted(segments, key=lambda segment: SEGMENT_PRIORITY.get(segment, DEFAULT_PRIORITY))
+        for occupation, chunk in chunked(segments, CHUNK_SIZE, order):
+            if broadcast.is_stale():
+                return
+            for msisdn in chunk:
+                if msisdn not in suppressed:
+                    call_dispatcher.enqueue(msisdn, message, occupation, broadcast)
+
+
+def send_chunk(broadcast, chunk, sender=None):
+    response = provider_send(broadcast.message, [msisdn_to_e164(msisdn) for msisdn in chunk], sender)
+    if response is None:
+        return None
+    broadcast.mark("first_sent")
+    broadcasts.record_response(broadcast, response)
+    for number in blacklisted_numbers(response):
+        msisdn = normalize_msisdn(number)
+        if msisdn is None:
+            continue
+        suppression_list.add(msisdn, BLACKLISTED)
+        # Patch the one bit rather than rebuild the whole index mid-broadcast
+        found = find_subscriber(msisdn)
+        if found is not None:
+            audience_index.flag("suppressed", found[0])
+    return response
+
+
+chunk_dispatcher = ChunkDispatcher(send_chunk)
+
+
+def broadcast_counts():
+    for broadcast in broadcasts.active():
+        for state in ("sent", "delivered", "failed", "expired", "superseded"):
+            yield (tenant_name(), broadcast.id, state), getattr(broadcast, state)
+
+
+# Read when /metrics is scraped, inside the scraped tenant's app context
+registry.register(Gauge("dharura_dispatch_queue_depth", "SMS chunks waiting for a dispatcher worker.",
+                        collect=lambda: [((), chunk_dispatcher.depth())]))
+registry.register(Gauge("dharura_voice_queue_depth", "Voice calls waiting to be placed.", ("tenant",),
+                        collect=lambda: [((tenant_name(),), call_dispatcher.pending())]))
+registry.register(Gauge("dharura_broadcast_recipients", "Recipients of each active broadcast by state.",
+                        ("tenant", "broadcast", "state"), collect=broadcast_counts))
+registry.register(Gauge("dharura_broadcast_throughput", "Recipients per second accepted for each active broadcast.",
+                        ("tenant", "broadcast"),
+                        collect=lambda: [((tenant_name(), b.id), b.throughput()) for b in broadcasts.active()]))
+
+
+def subscriber_pull(title, description, policy=None, ttl=ALERT_TTL, incident=None, audience=None, area=None):
+    broadcast = broadcasts.start(f"{title}, {description}", ttl, incident)
+    app = current_app._get_current_object()
+    if policy is not None:
+        watch(broadcast, policy, partial(retarget, app))
+
+    suppressed = suppression_list.numbers()
+    threading.Thread(target=fan_out, args=(app, broadcast, suppressed, audience, area), daemon=True).start()
+    return broadcast
+
+
+def fan_out(app, broadcast, suppressed, audience=None, area=None):
+    # Producer side only; chunks are sent (or expired) by the dispatcher workers.
+    # Any index rebuild here reads one read-only snapshot, and the resolved
+    # arrays are never mutated, so the recipient list is fixed for this broadcast.
+    profiled = profiler.begin("fan_out")
     try:
-        messages = f"{title}, {description}"
-        sender = "32721"
-        recipient = ["+255758405095"]
-        response = sms.send(messages, recipient, sender)
-        print(response)
-    except Exception as e:
-        print(e)
-
-def send_notifications_all(title, description):
-    msisdns = SubscriberModel.query.order_by(SubscriberModel.msisdn.desc()).all()
+        with app.app_context(), read_snapshot():
+            segments = resolve_segments(audience, area)
+        broadcast.mark("resolved")
+        dispatch_by_carrier(app, broadcast, carrier_of.partition(segments, suppressed))
+    finally:
+        if profiled:
+            profiler.end()
+    broadcast.fan_out_finished()
+
+
+def dispatch_by_carrier(app, broadcast, carriers):
+    # One producer per carrier, so a carrier whose lane is backed up only
+    # blocks its own feed while the dispatcher interleaves the rest
+    feeds = [threading.Thread(target=feed_carrier, args=(app, broadcast, carrier, numbers), daemon=True)
+             for carrier, numbers in carriers.items()]
+    for feed in feeds:
+        feed.start()
+    for feed in feeds:
+        feed.join()
+
+
+def feed_carrier(app, broadcast, carrier, numbers):
+    with app.app_context():
+        for start in range(0, len(numbers), CHUNK_SIZE):
+            if not chunk_dispatcher.submit(broadcast, numbers[start:start + CHUNK_SIZE], carrier):
+                break
+
+
+def retarget(app, broadcast, msisdns, channel):
+    # Escalation of the still-undelivered part of a broadcast. Numbers that
+    # opted out since the fan-out are left out.
+    with app.app_context():
+        suppressed = suppression_list.numbers()
+        if channel == "voice":
+            for msisdn in msisdns:
+                if msisdn not in suppressed:
+                    call_dispatcher.enqueue(msisdn, f"Emergency. {broadcast.message}", broadcast=broadcast)
+            return
+    dispatch_by_carrier(app, broadcast, carrier_of.partition({None: msisdns}, suppressed))
+
+
+def reprobe_quarantined():
+    msisdns = due_for_probe()
+    for start in range(0, len(msisdns), CHUNK_SIZE):
+        chunk = msisdns[start:start + CHUNK_SIZE]
+        if provider_send(PROBE_MESSAGE, [msisdn_to_e164(msisdn) for msisdn in chunk]) is not None:
+            mark_probed(chunk)
+    return len(msisdns)
+
@@ -0,0 +1,38 @@
+import re
+
+COUNTRY_CODE = "255"
+NATIONAL_LENGTH = 9
+MOBILE_PREFIXES = ("6", "7")
+
+_separators = re.compile(r"[\s\-().]")
+
+
+def normalize_msisdn(raw):
+    # Accepts +255712345678, 255712345678, 0712345678 and 712345678
+    # (with optional spaces/dashes) and returns 255712345678 as an int.
+    if raw is None:
+        return None
+    number = _separators.sub("", str(raw))
+    if number[:1] == "+":
+        number = number[1:]
+        if number[:len(COUNTRY_CODE)] != COUNTRY_CODE:
+            return None
+    elif number[:2] == "00":
+        number = number[2:]
+
+    if len(number) == len(COUNTRY_CODE) + NATIONAL_LENGTH and number[:len(COUNTRY_CODE)] == COUNTRY_CODE:
+        national = number[len(COUNTRY_CODE):]
+    elif len(number) == NATIONAL_LENGTH + 1 and number[:1] == "0":
+        national = number[1:]
+    elif len(number) == NATIONAL_LENGTH:
+        national = number
+    else:
+        return None
+
+    if not (national.isascii() and national.isdigit()) or national[:1] not in MOBILE_PREFIXES:
+        return None
+    return int(COUNTRY_CODE + national)
+
+
+def msisdn_to_e164(msisdn):
+    return f"+{msisdn}"
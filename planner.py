@@ -0,0 +1,68 @@
+import math
+
+# Recipients per second assumed when neither the senders nor the tenant budget throttle
+SMS_RATE_PER_SECOND = 100
+# Approximate price of one SMS part, in TZS
+SMS_PART_COST = 25
+AVERAGE_CALL_SECONDS = 30
+
+GSM_SINGLE, GSM_MULTI = 160, 153
+UCS2_SINGLE, UCS2_MULTI = 70, 67
+
+GSM_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM_EXTENDED = set("^{}\\[~]|€\f")
+
+
+def sms_parts(message):
+    if all(ch in GSM_BASIC or ch in GSM_EXTENDED for ch in message):
+        encoding = "GSM-7"
+        length = sum(2 if ch in GSM_EXTENDED else 1 for ch in message)
+        single, multi = GSM_SINGLE, GSM_MULTI
+    else:
+        encoding = "UCS-2"
+        length = len(message.encode("utf-16-le")) // 2
+        single, multi = UCS2_SINGLE, UCS2_MULTI
+    parts = 1 if length <= single else math.ceil(length / multi)
+    return {"encoding": encoding, "length": length, "parts": parts}
+
+
+def send_seconds(carriers, sender_rate=None, budget=None, carrier_rates=None):
+    # Every throttle counts recipients, not parts. The senders and the tenant
+    # budget are shared by all carriers, each carrier lane has its own rate;
+    # the slowest of them bounds the send. (seconds, what bounds it)
+    shared = [(rate, name) for rate, name in ((sender_rate, "senders"), (budget, "tenant budget")) if rate]
+    rate, bottleneck = min(shared) if shared else (SMS_RATE_PER_SECOND, "provider")
+    seconds = sum(carriers.values()) / rate
+    for carrier, count in carriers.items():
+        rate = (carrier_rates or {}).get(carrier)
+        if rate and count / rate > seconds:
+            seconds, bottleneck = count / rate, carrier
+    return seconds, bottleneck
+
+
+def plan_broadcast(message, segments, carriers, chunk_size, voice_message=None, voice_concurrency=1,
+                   sender_rate=None, budget=None, carrier_rates=None):
+    # segments and carriers: recipient counts per occupation segment and per
+    # carrier, as resolved from the indexes. The dispatcher chunks per carrier.
+    recipients = sum(segments.values())
+    sms = sms_parts(message)
+    total_parts = recipients * sms["parts"]
+    seconds, bottleneck = send_seconds(carriers, sender_rate, budget, carrier_rates)
+    plan = {
+        "recipients": recipients,
+        "segments": segments,
+        "carriers": carriers,
+        "variants": {"sms": sms},
+        "provider_requests": sum(math.ceil(count / chunk_size) for count in carriers.values()),
+        "sms_parts": total_parts,
+        "estimated_cost": total_parts * SMS_PART_COST,
+        "estimated_seconds": round(seconds, 1),
+        "bottleneck": bottleneck,
+    }
+    if voice_message is not None:
+        plan["variants"]["voice"] = {"length": len(voice_message), "calls": recipients}
+        plan["estimated_voice_seconds"] = math.ceil(recipients / voice_concurrency) * AVERAGE_CALL_SECONDS
+    return plan
@@ -0,0 +1,104 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from tenancy import INSTANCE_PATH
+
+# Fraction of requests and dispatched chunks to profile; 0 turns profiling off
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL = 0.005
+PROFILE_DUMP_INTERVAL = 60
+PROFILE_DIR = os.path.join(INSTANCE_PATH, "profiles")
+PROFILE_MAX_DEPTH = 128
+
+
+class StackSampler:
+    # Only threads inside a sampled request or chunk are registered; one
+    # background thread reads their stacks every interval, so unsampled work
+    # pays a single random() call
+    def __init__(self, rate=PROFILE_SAMPLE_RATE, interval=PROFILE_INTERVAL, directory=PROFILE_DIR):
+        self.rate = rate
+        self.interval = interval
+        self.directory = directory
+        self.stacks = Counter()
+        self.samples = 0
+        self._threads = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, rate):
+        self.rate = min(max(rate, 0.0), 1.0)
+
+    def begin(self, label):
+        # Registers the calling thread if it is picked; True if it was
+        if not self.rate or random.random() >= self.rate:
+            return False
+        self._threads[threading.get_ident()] = label
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        return True
+
+    def end(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def _frame_name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return name
+
+    def _collapse(self, label, frame):
+        names = []
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            names.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        names.append(label)
+        return ";".join(reversed(names))
+
+    def _run(self):
+        dumped = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            if self._threads:
+                frames = sys._current_frames()
+                with self._lock:
+                    for ident, label in list(self._threads.items()):
+                        frame = frames.get(ident)
+                        if frame is not None:
+                            self.stacks[self._collapse(label, frame)] += 1
+                            self.samples += 1
+                del frames
+            if time.monotonic() - dumped >= PROFILE_DUMP_INTERVAL:
+                dumped = time.monotonic()
+                try:
+                    self.dump()
+                except OSError:
+                    pass
+
+    def dump(self):
+        # Writes the stacks gathered since the last dump as collapsed stacks
+        # ("frame;frame;frame count"), ready for flamegraph.pl or speedscope.
+        # Returns the file path, None if nothing was sampled.
+        with self._lock:
+            stacks, self.stacks = self.stacks, Counter()
+        if not stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.folded")
+        with open(path, "a") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def status(self):
+        return {"rate": self.rate, "interval": self.interval, "profiling": len(self._threads),
+                "samples": self.samples, "pending_stacks": len(self.stacks)}
+
+
+profiler = StackSampler()
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from model import DeliveryHealthModel, SuppressionModel, db
+
+QUARANTINE_THRESHOLD = 3
+REPROBE_INTERVAL = timedelta(days=7)
+
+DELIVERED_STATUSES = ("Success",)
+FAILED_STATUSES = ("Failed", "Rejected")
+# Failures that say something about the number itself, not about our account
+DEAD_NUMBER_REASONS = (
+    "UserDoesNotExist",
+    "UserIsInactive",
+    "DeliveryFailure",
+    "AbsentSubscriber",
+    "NotNetworkSubscriber",
+)
+
+RECORD_FAILURE = (
+    'INSERT INTO delivery_health (msisdn, failures, quarantined, last_failure) VALUES (:msisdn, 1, :quarantined, :now) '
+    'ON CONFLICT(msisdn) DO UPDATE SET failures = failures + 1, last_failure = excluded.last_failure, '
+    'quarantined = CASE WHEN failures + 1 >= :threshold THEN 1 ELSE quarantined END '
+    'RETURNING failures'
+)
+CLEAR_FAILURES = 'DELETE FROM delivery_health WHERE msisdn = :msisdn RETURNING quarantined'
+
+
+def record_delivery_report(msisdn, status, failure_reason=None):
+    # Returns True when the report quarantined or released the number
+    if status in DELIVERED_STATUSES:
+        # A delivered message clears the counter and releases quarantine
+        row = db.session.execute(db.text(CLEAR_FAILURES), {"msisdn": msisdn}).first()
+        changed = row is not None and bool(row[0])
+    elif status in FAILED_STATUSES and failure_reason in DEAD_NUMBER_REASONS:
+        row = db.session.execute(db.text(RECORD_FAILURE), {
+            "msisdn": msisdn,
+            "quarantined": QUARANTINE_THRESHOLD <= 1,
+            "now": datetime.utcnow(),
+            "threshold": QUARANTINE_THRESHOLD,
+        }).first()
+        changed = row[0] == QUARANTINE_THRESHOLD
+    else:
+        return False
+    db.session.commit()
+    return changed
+
+
+def due_for_probe(now=None):
+    # Numbers that opted out are never probed
+    cutoff = (now or datetime.utcnow()) - REPROBE_INTERVAL
+    suppressed = db.select(SuppressionModel.msisdn).where(SuppressionModel.msisdn == DeliveryHealthModel.msisdn)
+    rows = db.session.execute(
+        db.select(DeliveryHealthModel.msisdn).where(
+            DeliveryHealthModel.quarantined.is_(True),
+            db.or_(DeliveryHealthModel.last_probe.is_(None), DeliveryHealthModel.last_probe < cutoff),
+            ~suppressed.exists(),
+        ).order_by(DeliveryHealthModel.msisdn)
+    )
+    return [row[0] for row in rows]
+
+
+def forget(msisdn):
+    # Drops the number's delivery record; left pending for the caller's commit
+    DeliveryHealthModel.query.filter_by(msisdn=msisdn).delete()
+
+
+def mark_probed(msisdns, now=None):
+    DeliveryHealthModel.query.filter(DeliveryHealthModel.msisdn.in_(msisdns)) \
+        .update({"last_probe": now or datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,25 @@
+import time
+
+
+class TokenBucket:
+    # Not thread-safe on its own; callers hold their own lock around it
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self, amount, now=None):
+        # Seconds until amount may be taken. Amounts above capacity only need a
+        # full bucket and leave it in debt, so oversized batches still pass.
+        self._refill(now or time.monotonic())
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount, now=None):
+        self._refill(now or time.monotonic())
+        self.tokens -= amount
@@ -0,0 +1,148 @@
+import heapq
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from model import ScheduledAlertModel, db
+from modules import subscriber_pull, voice_escalate
+from escalation import EscalationPolicy, ESCALATION_RATIO, ESCALATION_DEADLINE
+from broadcast import ALERT_TTL
+from tenancy import per_app
+from logs import log_failure
+
+PENDING = "pending"
+SENT = "sent"
+CANCELLED = "cancelled"
+# Furthest ahead an alert may be scheduled, in seconds
+MAX_SCHEDULE_DELAY = 366 * 24 * 3600
+
+log = logging.getLogger("dharura.scheduler")
+
+
+def to_timestamp(due_at):
+    return due_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def local_timezone(utc_offset_hours):
+    return timezone(timedelta(hours=utc_offset_hours))
+
+
+def parse_due_at(send_at=None, delay=None, local=timezone.utc):
+    # Returns a naive UTC datetime, or None when the alert is not scheduled.
+    # A send_at without an offset is a local time in the local timezone.
+    # Raises ValueError for anything unparseable or out of range.
+    if send_at:
+        due_at = datetime.fromisoformat(send_at)
+        if due_at.tzinfo is None:
+            due_at = due_at.replace(tzinfo=local)
+        try:
+            return due_at.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            raise ValueError("send_at out of range")
+    if delay:
+        delay = float(delay)
+        if not (math.isfinite(delay) and 0 <= delay <= MAX_SCHEDULE_DELAY):
+            raise ValueError("delay out of range")
+        return datetime.utcfromtimestamp(time.time() + delay)
+    return None
+
+
+class AlertScheduler:
+    def __init__(self):
+        self._heap = []
+        self._cancelled = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._app = None
+
+    def start(self, app):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._app = app
+            rows = db.session.execute(
+                db.select(ScheduledAlertModel.id, ScheduledAlertModel.due_at)
+                .where(ScheduledAlertModel.status == PENDING)
+            )
+            self._heap = [(to_timestamp(due_at), alert_id) for alert_id, due_at in rows]
+            heapq.heapify(self._heap)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._heap) - len(self._cancelled)
+
+    def schedule(self, title, description, due_at, critical=False, ttl=None, incident=None, audience=None,
+                 area=None, policy=None):
+        alert = ScheduledAlertModel(title=title, description=description, due_at=due_at,
+                                    critical=critical, ttl=ttl, incident=incident, audience=audience,
+                                    area=json.dumps(area) if area else None)
+        if policy is not None:
+            alert.escalate_ratio, alert.escalate_after, alert.escalate_via = \
+                policy.ratio, policy.deadline, policy.channel
+        db.session.add(alert)
+        db.session.commit()
+        with self._condition:
+            heapq.heappush(self._heap, (to_timestamp(due_at), alert.id))
+            self._condition.notify()
+        return alert
+
+    def cancel(self, alert_id):
+        updated = ScheduledAlertModel.query.filter_by(id=alert_id, status=PENDING).update({"status": CANCELLED})
+        db.session.commit()
+        if updated:
+            # Lazy deletion: the heap entry is skipped when it comes due
+            with self._condition:
+                self._cancelled.add(alert_id)
+        return bool(updated)
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, alert_id = self._heap[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if alert_id in self._cancelled:
+                    self._cancelled.discard(alert_id)
+                    continue
+                return alert_id
+
+    def _run(self):
+        while True:
+            alert_id = self._next_due()
+            try:
+                with self._app.app_context():
+                    self.fire(alert_id)
+            except Exception:
+                log_failure(log, "scheduled_alert_failed", alert=alert_id)
+
+    def fire(self, alert_id):
+        updated = ScheduledAlertModel.query.filter_by(id=alert_id, status=PENDING).update({"status": SENT})
+        db.session.commit()
+        if not updated:
+            return None
+        alert = db.session.get(ScheduledAlertModel, alert_id)
+        area = json.loads(alert.area) if alert.area else None
+        policy = None
+        if (alert.escalate_ratio, alert.escalate_after, alert.escalate_via) != (None, None, None):
+            policy = EscalationPolicy(
+                ratio=ESCALATION_RATIO if alert.escalate_ratio is None else alert.escalate_ratio,
+                deadline=alert.escalate_after or ESCALATION_DEADLINE,
+                channel=alert.escalate_via or "sms",
+            )
+        broadcast = subscriber_pull(alert.title, alert.description, policy,
+                                    alert.ttl or ALERT_TTL, alert.incident, alert.audience, area)
+        if alert.critical:
+            voice_escalate(broadcast, alert.title, alert.description, alert.audience, area)
+        return broadcast
+
+
+alert_scheduler = per_app("alert_scheduler", AlertScheduler)
@@ -0,0 +1,130 @@
+import threading
+import time
+from flask import current_app
+from ratelimit import TokenBucket
+from tenancy import per_app
+
+SENDER_FAILURE_THRESHOLD = 3
+SENDER_COOLDOWN = 60
+# Recipient statuses that say the sender itself is unusable, not the number
+SENDER_FAILURE_STATUSES = ("InvalidSenderId", "InsufficientBalance", "RiskHold", "CouldNotRoute")
+
+
+class Sender:
+    def __init__(self, sender_id, rate=None):
+        # rate: recipients per second the provider allows this sender ID or
+        # short code, None when it isn't throttled on our side
+        self.id = sender_id
+        self.bucket = TokenBucket(rate) if rate else None
+        self.inflight = 0
+        self.failures = 0
+        self.disabled_until = 0
+        self.sent = 0
+
+    def healthy(self, now):
+        return self.disabled_until <= now
+
+    def wait_time(self, count, now):
+        return self.bucket.wait_time(count, now) if self.bucket else 0.0
+
+    def status(self, now):
+        return {
+            "id": self.id,
+            "rate": self.bucket.rate if self.bucket else None,
+            "healthy": self.healthy(now),
+            "failures": self.failures,
+            "sent": self.sent,
+        }
+
+
+class SenderPool:
+    def __init__(self, senders):
+        self.senders = senders
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        # SMS_SENDERS: ["32721", {"id": "DHARURA", "rate": 50}, ...], else just SMS_SENDER
+        senders = []
+        for entry in config.get("SMS_SENDERS") or [config["SMS_SENDER"]]:
+            if isinstance(entry, dict):
+                senders.append(Sender(entry["id"], entry.get("rate")))
+            else:
+                senders.append(Sender(entry))
+        return cls(senders)
+
+    def __len__(self):
+        return len(self.senders)
+
+    def rate(self):
+        # Aggregate recipients per second, None if any sender is unthrottled
+        if all(sender.bucket for sender in self.senders):
+            return sum(sender.bucket.rate for sender in self.senders)
+        return None
+
+    def _pick(self, count, exclude, now):
+        # (sender that frees up first, seconds until it can take count); ties
+        # go to the one with fewest sends in flight, so concurrent workers
+        # spread across senders. Unhealthy senders are only used when nothing
+        # else is left.
+        candidates = [s for s in self.senders if s not in exclude] or self.senders
+        candidates = [s for s in candidates if s.healthy(now)] or candidates
+        sender = min(candidates, key=lambda s: (s.wait_time(count, now), s.inflight))
+        return sender, sender.wait_time(count, now)
+
+    def _reserve(self, sender, count, now):
+        if sender.bucket:
+            sender.bucket.take(count, now)
+        sender.inflight += 1
+
+    def try_acquire(self, count, exclude=()):
+        # (sender reserved for count recipients, None), or (None, seconds to
+        # wait) without reserving anything. For callers that must not sleep.
+        with self._lock:
+            now = time.monotonic()
+            sender, delay = self._pick(count, exclude, now)
+            if delay:
+                return None, delay
+            self._reserve(sender, count, now)
+        return sender, None
+
+    def acquire(self, count, exclude=()):
+        # Reserves count recipients and waits for the sender outside the lock
+        with self._lock:
+            now = time.monotonic()
+            sender, delay = self._pick(count, exclude, now)
+            self._reserve(sender, count, now)
+        if delay:
+            time.sleep(delay)
+        return sender
+
+    def succeeded(self, sender, count=0):
+        with self._lock:
+            sender.inflight -= 1
+            sender.sent += count
+            sender.failures = 0
+            sender.disabled_until = 0
+
+    def failed(self, sender):
+        with self._lock:
+            sender.inflight -= 1
+            sender.failures += 1
+            if sender.failures >= SENDER_FAILURE_THRESHOLD:
+                sender.disabled_until = time.monotonic() + SENDER_COOLDOWN
+
+    def report(self, sender, response, count):
+        # A response where every recipient failed for a sender-level reason
+        # counts against the sender's health
+        recipients = response.get("SMSMessageData", {}).get("Recipients", []) if isinstance(response, dict) else []
+        if recipients and all(r.get("status") in SENDER_FAILURE_STATUSES for r in recipients):
+            self.failed(sender)
+        else:
+            self.succeeded(sender, count)
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            return [sender.status(now) for sender in self.senders]
+
+
+sender_pool = per_app("sender_pool", lambda: SenderPool.from_config(current_app.config))
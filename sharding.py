@@ -0,0 +1,220 @@
+import heapq
+import os
+import queue
+import threading
+from operator import itemgetter
+from flask import current_app
+from sqlalchemy.orm import Session
+from model import SubscriberModel, SubscriberStatsModel, db
+from database import READER_PRAGMAS, SCAN_BATCH, create_pooled_engine, query_rows, reader_connection, timed_scan
+from importer import upsert_batch
+from exporter import subscriber_pages
+
+SCAN_QUEUE_DEPTH = 4
+
+
+class SubscriberShards:
+    def __init__(self, paths, primary):
+        # Shard i holds the subscribers whose msisdn % len(paths) == i. The
+        # readers attach the primary database, so scans can still join
+        # suppressions and delivery_health.
+        self.count = len(paths)
+        self.paths = paths
+        self.writers = [create_pooled_engine(path) for path in paths]
+        self.readers = [create_pooled_engine(path, READER_PRAGMAS, read_only=True,
+                                             attach={"primary_db": primary})
+                        for path in paths]
+
+    def shard_of(self, msisdn):
+        return msisdn % self.count
+
+    def global_id(self, shard, local_id):
+        # Local rowids interleaved across shards, so ids stay unique and dense
+        return local_id * self.count + shard
+
+
+def init_shards(app):
+    # SUBSCRIBER_SHARDS of 0 or 1 keeps subscribers in the primary database
+    count = int(app.config.get("SUBSCRIBER_SHARDS") or 0)
+    if count > 1:
+        paths = [os.path.join(app.instance_path, f"subscribers-{i}.db") for i in range(count)]
+        with app.app_context():
+            app.extensions["subscriber_shards"] = SubscriberShards(paths, db.engine.url.database)
+
+
+def subscriber_shards():
+    return current_app.extensions.get("subscriber_shards")
+
+
+def subscriber_engines():
+    # Writable engines holding subscribers rows, one per shard
+    shards = subscriber_shards()
+    return shards.writers if shards is not None else [db.engine]
+
+
+def create_shard_tables():
+    shards = subscriber_shards()
+    if shards is not None:
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        for engine in shards.writers:
+            SubscriberModel.__table__.create(engine, checkfirst=True)
+            SubscriberStatsModel.__table__.create(engine, checkfirst=True)
+
+
+def find_subscriber(msisdn):
+    # (global id, subscriber) for msisdn, None if not subscribed
+    shards = subscriber_shards()
+    if shards is None:
+        subscriber = SubscriberModel.query.filter_by(msisdn=msisdn).first()
+        return None if subscriber is None else (subscriber.id, subscriber)
+    shard = shards.shard_of(msisdn)
+    with Session(shards.writers[shard], expire_on_commit=False) as session:
+        subscriber = session.query(SubscriberModel).filter_by(msisdn=msisdn).first()
+        if subscriber is None:
+            return None
+        session.expunge(subscriber)
+        return shards.global_id(shard, subscriber.id), subscriber
+
+
+def add_subscriber(subscriber):
+    # Commits subscriber to the database holding its msisdn, returns its global id
+    shards = subscriber_shards()
+    if shards is None:
+        db.session.add(subscriber)
+        db.session.commit()
+        return subscriber.id
+    shard = shards.shard_of(subscriber.msisdn)
+    with Session(shards.writers[shard], expire_on_commit=False) as session:
+        session.add(subscriber)
+        session.commit()
+        return shards.global_id(shard, subscriber.id)
+
+
+def remove_subscriber(msisdn):
+    # Returns (global id, occupation) of the removed subscriber, None if there
+    # was none. Unsharded, the delete is left pending on db.session for the
+    # caller's commit.
+    shards = subscriber_shards()
+    if shards is None:
+        subscriber = SubscriberModel.query.filter_by(msisdn=msisdn).first()
+        if subscriber is None:
+            return None
+        db.session.delete(subscriber)
+        return subscriber.id, subscriber.occupation
+    shard = shards.shard_of(msisdn)
+    with Session(shards.writers[shard]) as session:
+        subscriber = session.query(SubscriberModel).filter_by(msisdn=msisdn).first()
+        if subscriber is None:
+            return None
+        removed = (shards.global_id(shard, subscriber.id), subscriber.occupation)
+        session.delete(subscriber)
+        session.commit()
+        return removed
+
+
+def write_batches(write, rows):
+    # write(engine, rows) once per shard, the shards in parallel
+    shards = subscriber_shards()
+    if shards is None:
+        write(db.engine, rows)
+        return
+    batches = {}
+    for row in rows:
+        batches.setdefault(shards.shard_of(row[0]), []).append(row)
+    errors = []
+
+    def run(engine, batch):
+        try:
+            write(engine, batch)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(shards.writers[shard], batch))
+               for shard, batch in batches.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _produce(con, sql, params, out, stop):
+    try:
+        for rows in timed_scan(con.cursor(), sql, params):
+            if stop.is_set():
+                break
+            out.put(rows)
+        out.put(None)
+    except Exception as e:
+        out.put(e)
+
+
+def _drain(out):
+    while True:
+        rows = out.get()
+        if rows is None:
+            return
+        if isinstance(rows, Exception):
+            raise rows
+        yield from rows
+
+
+def scan_subscribers(sql, ordered=False):
+    # Streams sql over every shard at once. sql sees :shards and :shard so it
+    # can select global ids (id * :shards + :shard). ordered merges the shard
+    # streams on their first column, which each shard must already sort by.
+    shards = subscriber_shards()
+    if shards is None:
+        yield from query_rows(sql, {"shards": 1, "shard": 0})
+        return
+
+    stop = threading.Event()
+    contexts = [reader_connection(engine) for engine in shards.readers]
+    cons = [context.__enter__() for context in contexts]
+    if ordered:
+        outs = [queue.Queue(SCAN_QUEUE_DEPTH) for _ in cons]
+    else:
+        outs = [queue.Queue(SCAN_QUEUE_DEPTH * len(cons))] * len(cons)
+    threads = [threading.Thread(target=_produce, daemon=True,
+                                args=(con, sql, {"shards": shards.count, "shard": shard}, out, stop))
+               for shard, (con, out) in enumerate(zip(cons, outs))]
+    try:
+        for thread in threads:
+            thread.start()
+        if ordered:
+            yield from heapq.merge(*map(_drain, outs), key=itemgetter(0))
+        else:
+            # One shared queue; batches arrive in whatever order shards finish them
+            finished = 0
+            while finished < len(threads):
+                rows = outs[0].get()
+                if rows is None:
+                    finished += 1
+                elif isinstance(rows, Exception):
+                    raise rows
+                else:
+                    yield from rows
+    finally:
+        stop.set()
+        for out, thread in zip(outs, threads):
+            # Unblock producers stuck on a full queue before releasing connections
+            while thread.is_alive():
+                try:
+                    out.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+        for context in contexts:
+            context.__exit__(None, None, None)
+
+
+def move_to_shards(page_size=SCAN_BATCH):
+    # Moves rows left in the primary subscribers table into their shards.
+    # The upsert is idempotent, so an interrupted move can simply be rerun.
+    moved = 0
+    for rows in subscriber_pages(db.engine, page_size):
+        write_batches(upsert_batch, [row[1:] for row in rows])
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('DELETE FROM subscribers WHERE id <= ?', (rows[-1][0],))
+        moved += len(rows)
+    return moved
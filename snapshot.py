@@ -0,0 +1,108 @@
+import threading
+from array import array
+
+
+class RecipientSnapshot:
+    def __init__(self, loader, data_version=None):
+        # loader() yields (msisdn, segment) rows for every targetable subscriber;
+        # data_version() changes when another process rewrites them in bulk
+        self._loader = loader
+        self._data_version = data_version
+        self._loaded_version = None
+        self._segments = None
+        self._added = {}
+        self._removed = {}
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._segments = None
+            self._added.clear()
+            self._removed.clear()
+            self.version += 1
+
+    def caught_up(self, version):
+        # This process moved the data version to version and already patched
+        # itself; only a change from elsewhere makes it reload
+        with self._lock:
+            if self._loaded_version is not None and self._loaded_version == version - 1:
+                self._loaded_version = version
+
+    def add(self, msisdn, segment):
+        with self._lock:
+            if self._segments is None:
+                return
+            removed = self._removed.get(segment)
+            if removed and msisdn in removed:
+                removed.discard(msisdn)
+            else:
+                self._added.setdefault(segment, set()).add(msisdn)
+            self.version += 1
+
+    def remove(self, msisdn, segment):
+        with self._lock:
+            if self._segments is None:
+                return
+            added = self._added.get(segment)
+            if added and msisdn in added:
+                added.discard(msisdn)
+            else:
+                self._removed.setdefault(segment, set()).add(msisdn)
+            self.version += 1
+
+    def view(self):
+        # Published arrays are never mutated, so callers may iterate them
+        # without holding the lock while later patches build new ones
+        current = self._data_version() if self._data_version else None
+        with self._lock:
+            if self._segments is not None and current != self._loaded_version:
+                self._segments = None
+                self._added.clear()
+                self._removed.clear()
+                self.version += 1
+            if self._segments is None:
+                self._segments = self._load()
+                self._loaded_version = current
+            elif self._added or self._removed:
+                self._segments = self._merge()
+            return self.version, self._segments
+
+    def __len__(self):
+        return sum(len(numbers) for numbers in self.view()[1].values())
+
+    def _load(self):
+        segments = {}
+        for msisdn, segment in self._loader():
+            numbers = segments.get(segment)
+            if numbers is None:
+                numbers = segments[segment] = array('q')
+            numbers.append(msisdn)
+        return segments
+
+    def _merge(self):
+        segments = dict(self._segments)
+        for segment in set(self._added) | set(self._removed):
+            numbers = array('q', segments.get(segment, ()))
+            removed = self._removed.get(segment)
+            if removed:
+                if len(removed) < 64:
+                    for msisdn in removed:
+                        try:
+                            numbers.remove(msisdn)
+                        except ValueError:
+                            pass
+                else:
+                    numbers = array('q', (msisdn for msisdn in numbers if msisdn not in removed))
+            numbers.extend(self._added.get(segment, ()))
+            segments[segment] = numbers
+        self._added.clear()
+        self._removed.clear()
+        return segments
+
+
+def chunked(segments, size, order=None):
+    for segment in order or segments:
+        numbers = segments.get(segment, ())
+        for start in range(0, len(numbers), size):
+            yield segment, numbers[start:start + size]
@@ -0,0 +1,73 @@
+import logging
+import threading
+from sharding import subscriber_engines
+from logs import log_failure
+
+STATS_RECONCILE_INTERVAL = 60 * 60
+
+log = logging.getLogger("dharura.stats")
+
+# Counters are kept by triggers so that ORM writes, bulk imports and raw
+# deletes all update them inside the same transaction as the row change
+STATS_TRIGGERS = (
+    'CREATE TRIGGER IF NOT EXISTS subscriber_stats_insert AFTER INSERT ON subscribers BEGIN '
+    "INSERT INTO subscriber_stats (segment, count) VALUES (COALESCE(NEW.occupation, ''), 1) "
+    'ON CONFLICT(segment) DO UPDATE SET count = count + 1; END',
+    'CREATE TRIGGER IF NOT EXISTS subscriber_stats_delete AFTER DELETE ON subscribers BEGIN '
+    "UPDATE subscriber_stats SET count = count - 1 WHERE segment = COALESCE(OLD.occupation, ''); END",
+    'CREATE TRIGGER IF NOT EXISTS subscriber_stats_update AFTER UPDATE OF occupation ON subscribers '
+    'WHEN COALESCE(OLD.occupation, \'\') != COALESCE(NEW.occupation, \'\') BEGIN '
+    "UPDATE subscriber_stats SET count = count - 1 WHERE segment = COALESCE(OLD.occupation, ''); "
+    "INSERT INTO subscriber_stats (segment, count) VALUES (COALESCE(NEW.occupation, ''), 1) "
+    'ON CONFLICT(segment) DO UPDATE SET count = count + 1; END',
+)
+
+RECONCILE_STATS = (
+    'DELETE FROM subscriber_stats',
+    "INSERT INTO subscriber_stats (segment, count) "
+    "SELECT COALESCE(occupation, ''), COUNT(*) FROM subscribers GROUP BY COALESCE(occupation, '')",
+)
+
+
+SELECT_STATS = 'SELECT segment, count FROM subscriber_stats'
+
+
+def install_stats():
+    # Each shard keeps its own counters next to its own subscribers
+    for engine in subscriber_engines():
+        with engine.begin() as conn:
+            for trigger in STATS_TRIGGERS:
+                conn.exec_driver_sql(trigger)
+
+
+def reconcile_stats():
+    # One transaction per database, so concurrent writers see either the old or new counters
+    for engine in subscriber_engines():
+        with engine.begin() as conn:
+            for statement in RECONCILE_STATS:
+                conn.exec_driver_sql(statement)
+
+
+def subscriber_stats():
+    segments = {}
+    for engine in subscriber_engines():
+        with engine.connect() as conn:
+            for segment, count in conn.exec_driver_sql(SELECT_STATS):
+                segments[segment] = segments.get(segment, 0) + count
+    segments = {segment: count for segment, count in segments.items() if count}
+    return {"total": sum(segments.values()), "segments": segments}
+
+
+def start_reconciler(app, interval=STATS_RECONCILE_INTERVAL):
+    def run():
+        try:
+            with app.app_context():
+                reconcile_stats()
+        except Exception:
+            log_failure(log, "stats_reconcile_failed")
+        start_reconciler(app, interval)
+
+    timer = threading.Timer(interval, run)
+    timer.daemon = True
+    timer.start()
+    return timer
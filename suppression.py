@@ -0,0 +1,77 @@
+import threading
+from model import SuppressionModel, db
+from sharding import remove_subscriber
+from quarantine import forget
+from tenancy import per_app
+from database import data_version
+
+UNSUBSCRIBED = "Unsubscribed"
+BLACKLISTED = "Blacklisted"
+
+STOP_KEYWORDS = ("STOP", "UNSUBSCRIBE", "STOPALL", "END", "CANCEL")
+BLACKLIST_STATUS = "UserInBlacklist"
+
+
+class SuppressionList:
+    def __init__(self, data_version=None):
+        # data_version() changes when another process unsubscribes a number
+        self._data_version = data_version
+        self._loaded_version = None
+        self._numbers = None
+        self._lock = threading.Lock()
+
+    def numbers(self):
+        current = self._data_version() if self._data_version else None
+        if self._numbers is None or current != self._loaded_version:
+            with self._lock:
+                if self._numbers is None or current != self._loaded_version:
+                    rows = db.session.execute(db.select(SuppressionModel.msisdn))
+                    self._numbers = {row[0] for row in rows}
+                    self._loaded_version = current
+        return self._numbers
+
+    def caught_up(self, version):
+        # This process moved the data version to version and already patched
+        # itself; only a change from elsewhere makes it reload
+        with self._lock:
+            if self._loaded_version is not None and self._loaded_version == version - 1:
+                self._loaded_version = version
+
+    def __contains__(self, msisdn):
+        return msisdn in self.numbers()
+
+    def __len__(self):
+        return len(self.numbers())
+
+    def add(self, msisdn, reason):
+        db.session.merge(SuppressionModel(msisdn=msisdn, reason=reason))
+        db.session.commit()
+        self.numbers().add(msisdn)
+
+    def remove(self, msisdn):
+        SuppressionModel.query.filter_by(msisdn=msisdn).delete()
+        db.session.commit()
+        self.numbers().discard(msisdn)
+
+
+suppression_list = per_app("suppression_list", lambda: SuppressionList(data_version))
+
+
+def unsubscribe(msisdn, reason=UNSUBSCRIBED):
+    # Returns (id, occupation) of the removed subscriber, None if there was none
+    removed = remove_subscriber(msisdn)
+    forget(msisdn)
+    suppression_list.add(msisdn, reason)
+    return removed
+
+
+def is_stop_request(text):
+    return (text or "").strip().upper().replace(" ", "") in STOP_KEYWORDS
+
+
+def blacklisted_numbers(response):
+    # Recipients the provider refused because they opted out on its side
+    if not isinstance(response, dict):
+        return []
+    recipients = response.get("SMSMessageData", {}).get("Recipients", [])
+    return [r.get("number") for r in recipients if r.get("status") == BLACKLIST_STATUS]
@@ -0,0 +1,42 @@
+import json
+import os
+import threading
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+INSTANCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance")
+TENANTS_FILE = os.path.join(INSTANCE_PATH, "tenants.json")
+
+_lock = threading.Lock()
+
+
+def load_tenants(path=TENANTS_FILE):
+    # {"udsm": {"SMS_SENDER": "...", "REDIRECT_URL": "...", "SMS_RATE_BUDGET": 50, ...}}
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def tenant_instance_path(tenant):
+    # Each tenant's database, shards and import reports live under its own folder
+    return os.path.join(INSTANCE_PATH, "tenants", tenant)
+
+
+def tenant_name():
+    return current_app.config.get("TENANT") or "default"
+
+
+def per_app(name, factory):
+    # Module-level singleton that is really one instance per Flask app, and so
+    # one per tenant. Background threads already push their app's context.
+    def get():
+        state = current_app.extensions.setdefault("tenant_state", {})
+        instance = state.get(name)
+        if instance is None:
+            with _lock:
+                instance = state.get(name)
+                if instance is None:
+                    instance = state[name] = factory()
+        return instance
+    return LocalProxy(get)
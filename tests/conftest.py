@@ -0,0 +1,15 @@
+import pytest
+from flask import Flask
+from database import init_database
+from model import db
+
+
+@pytest.fixture
+def app(tmp_path):
+    # A bare app on a throwaway SQLite database, with its context pushed
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'dharura.db'}"
+    init_database(app)
+    with app.app_context():
+        db.create_all()
+        yield app
@@ -0,0 +1,90 @@
+import pytest
+from audience import BitmapIndex, parse
+from bitmap import RoaringBitmap
+
+# (id, msisdn, occupation, campus, language, hostel, faculty, zone)
+ROWS = [
+    (1, 255712000001, "Staff", "Main", "sw", None, "Law", None),
+    (2, 255742000002, "Student", "Main", "en", "Hall 1", "Law", None),
+    (3, 255682000003, "Student", "Mabibo", "sw", "Hall 2", "Science", None),
+    (4, 255612000004, "Student", "Main", "en", "Hall 1", "Science", None),
+    (70000, 255752000005, "Staff", "Mabibo", "en", None, "Science", None),
+]
+
+
+def make_index(flags=None, version=None):
+    flags = flags or {}
+    return BitmapIndex(lambda: iter(ROWS), lambda flag: flags.get(flag, ()),
+                       (lambda: version[0]) if version else None)
+
+
+def ids(bitmap):
+    return sorted(bitmap)
+
+
+def test_parse_precedence():
+    assert parse("Staff OR Student AND NOT campus=Main") == \
+        ("or", ("name", "Staff"), ("and", ("name", "Student"), ("not", ("eq", "campus", "Main"))))
+    assert parse('(Staff or Student) and hostel="Hall 1"') == \
+        ("and", ("or", ("name", "Staff"), ("name", "Student")), ("eq", "hostel", "Hall 1"))
+
+
+@pytest.mark.parametrize("expression", [
+    "", "Staff AND", "(Staff", "Staff)", "= Staff", "colour=red", "Stafff", "Staff Student",
+])
+def test_parse_rejects(expression):
+    with pytest.raises(ValueError):
+        parse(expression)
+
+
+def test_evaluate():
+    index = make_index()
+    assert ids(index.evaluate("all")) == [1, 2, 3, 4, 70000]
+    assert ids(index.evaluate("Staff")) == [1, 70000]
+    assert ids(index.evaluate("Student AND campus=Main")) == [2, 4]
+    assert ids(index.evaluate('hostel="Hall 1" OR faculty=Law')) == [1, 2, 4]
+    assert ids(index.evaluate("NOT language=en")) == [1, 3]
+    assert ids(index.evaluate("zone=Nowhere")) == []
+
+
+def test_quarantined_are_not_targetable_and_suppressed_not_counted():
+    index = make_index({"quarantined": [3], "suppressed": [2]})
+    assert ids(index.evaluate("Student")) == [2, 3, 4]
+    assert ids(index.targetable("Student")) == [2, 4]
+    assert ids(index.evaluate("quarantined")) == [3]
+    segments, carriers = index.breakdown("all")
+    assert segments == {"Staff": 2, "Student": 1}
+    assert carriers == {"Tigo": 1, "Halotel": 1, "Vodacom": 1}
+
+
+def test_breakdown_within_area():
+    segments, carriers = make_index().breakdown("all", RoaringBitmap.from_sorted([3, 70000]))
+    assert segments == {"Staff": 1, "Student": 1}
+    assert carriers == {"Airtel": 1, "Vodacom": 1}
+
+
+def test_segments_resolve_msisdns():
+    segments = make_index().segments("faculty=Science")
+    assert list(segments["Staff"]) == [255752000005]
+    assert list(segments["Student"]) == [255682000003, 255612000004]
+
+
+def test_incremental_updates():
+    index = make_index()
+    index.evaluate("all")
+    index.add(80000, 255782000006, {"occupation": "Staff", "campus": "Main"})
+    index.remove(1)
+    index.flag("suppressed", 2)
+    assert ids(index.evaluate("Staff AND campus=Main")) == [80000]
+    assert ids(index.evaluate("suppressed")) == [2]
+    assert index.breakdown("all")[1]["Airtel"] == 2
+
+
+def test_reloads_when_data_version_moves():
+    version = [1]
+    index = make_index(version=version)
+    index.evaluate("all")
+    index.remove(1)
+    assert 1 not in index.evaluate("all")
+    version[0] = 2
+    assert 1 in index.evaluate("all")
@@ -0,0 +1,91 @@
+import threading
+import time
+import pytest
+from flask import Flask
+from broadcast import Broadcast
+from dispatcher import ChunkDispatcher
+
+
+def tenant(name, **config):
+    app = Flask(name)
+    app.config["SMS_SENDER"] = name
+    app.config.update(config)
+    return app
+
+
+@pytest.fixture
+def paused(monkeypatch):
+    # No worker threads: the test takes chunks itself, in dispatch order
+    dispatcher = ChunkDispatcher(lambda broadcast, chunk, sender: None, quantum=10)
+    monkeypatch.setattr(dispatcher, "_start", lambda: None)
+    return dispatcher
+
+
+def submit(dispatcher, app, broadcast, chunks, carrier=None):
+    with app.app_context():
+        for chunk in chunks:
+            dispatcher.submit(broadcast, chunk, carrier)
+
+
+def test_expired_chunks_are_dropped_before_sending():
+    started, release = threading.Event(), threading.Event()
+    sent = []
+
+    def send(broadcast, chunk, sender):
+        sent.append(list(chunk))
+        started.set()
+        release.wait(5)
+
+    dispatcher = ChunkDispatcher(send, workers=1)
+    broadcast = Broadcast("Fire", ttl=60)
+    app = tenant("udsm")
+    submit(dispatcher, app, broadcast, [[n] * 10 for n in range(3)])
+    assert started.wait(5)
+    broadcast.expires_at = time.time() - 1
+    release.set()
+    dispatcher.join()
+    with app.app_context():
+        assert not dispatcher.submit(broadcast, [9] * 5)
+    assert sent == [[0] * 10]
+    assert broadcast.expired == 25
+    assert broadcast.chunks_pending == 0
+    assert dispatcher.depth() == 0
+
+
+def test_tenants_take_turns_by_weight(paused):
+    small, large = tenant("small"), tenant("large", FAIR_SHARE_WEIGHT=2)
+    submit(paused, small, Broadcast("a"), [[n] * 10 for n in range(6)])
+    submit(paused, large, Broadcast("b"), [[n] * 10 for n in range(6)])
+    order = [paused._next()[0].name for _ in range(12)]
+    assert order[:9] == ["small", "large", "large"] * 3
+    assert order.count("small") == order.count("large") == 6
+
+
+def test_late_tenant_is_not_starved(paused):
+    busy, late = tenant("busy"), tenant("late")
+    submit(paused, busy, Broadcast("a"), [[n] * 10 for n in range(20)])
+    submit(paused, late, Broadcast("b"), [[1] * 10])
+    order = [paused._next()[0].name for _ in range(3)]
+    assert "late" in order
+
+
+def test_carriers_interleave_within_a_tenant(paused):
+    app = tenant("udsm")
+    broadcast = Broadcast("Fire")
+    submit(paused, app, broadcast, [[255740000000 + n] * 10 for n in range(3)], "Vodacom")
+    submit(paused, app, broadcast, [[255680000000 + n] * 10 for n in range(3)], "Airtel")
+    order = [paused._next()[2][0] for _ in range(6)]
+    assert order == [255740000000, 255680000000, 255740000001, 255680000001, 255740000002, 255680000002]
+    assert paused.depth() == 0
+
+
+def test_throttled_sender_does_not_hold_up_other_tenants(paused):
+    slow = tenant("slow", SMS_SENDERS=[{"id": "SLOW", "rate": 10}])
+    fast = tenant("fast")
+    submit(paused, slow, Broadcast("a"), [[n] * 10 for n in range(5)])
+    submit(paused, fast, Broadcast("b"), [[1] * 10])
+    started = time.monotonic()
+    first, second = paused._next(), paused._next()
+    assert (first[0].name, first[3].id) == ("slow", "SLOW")
+    assert (second[0].name, second[3].id) == ("fast", "fast")
+    assert time.monotonic() - started < 0.5
@@ -0,0 +1,64 @@
+import contextlib
+import pytest
+import modules
+from broadcast import Broadcast
+from escalation import EscalationPolicy, check
+from suppression import suppression_list, UNSUBSCRIBED
+
+UNDELIVERED = [255712000001, 255712000002, 255712000003]
+
+
+class FakeCalls:
+    def __init__(self):
+        self.calls = []
+
+    def enqueue(self, msisdn, message, occupation=None, broadcast=None):
+        self.calls.append(msisdn)
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    sent = []
+
+    def dispatch(app, broadcast, carriers):
+        for numbers in carriers.values():
+            sent.extend(numbers)
+    monkeypatch.setattr(modules, "dispatch_by_carrier", dispatch)
+    return sent
+
+
+def test_sms_retry_skips_numbers_that_opted_out(app, dispatched):
+    suppression_list.add(255712000003, UNSUBSCRIBED)
+    modules.retarget(app, Broadcast("Fire"), UNDELIVERED, "sms")
+    assert sorted(dispatched) == [255712000001, 255712000002]
+
+
+def test_voice_retry_skips_numbers_that_opted_out(app, monkeypatch):
+    calls = FakeCalls()
+    monkeypatch.setattr(modules, "call_dispatcher", calls)
+    suppression_list.add(255712000001, UNSUBSCRIBED)
+    modules.retarget(app, Broadcast("Fire"), UNDELIVERED, "voice")
+    assert calls.calls == [255712000002, 255712000003]
+
+
+def test_check_retargets_only_below_ratio():
+    retargets = []
+    broadcast = Broadcast("Fire")
+    broadcast.sent, broadcast.delivered = 10, 9
+    broadcast._undelivered = {255712000001}
+    policy = EscalationPolicy(ratio=0.9, deadline=1)
+    assert not check(broadcast, policy, lambda *args: retargets.append(args))
+    broadcast.delivered = 8
+    assert check(broadcast, policy, lambda *args: retargets.append(args))
+    assert retargets == [(broadcast, [255712000001], "sms")]
+    assert not check(broadcast, policy, lambda *args: retargets.append(args))
+
+
+def test_calls_are_queued_highest_priority_segment_first(app, monkeypatch):
+    calls = FakeCalls()
+    monkeypatch.setattr(modules, "call_dispatcher", calls)
+    monkeypatch.setattr(modules, "read_snapshot", contextlib.nullcontext)
+    monkeypatch.setattr(modules, "resolve_segments", lambda audience, area: {
+        "Student": [255712000001, 255712000002], "Visitor": [255712000009], "Staff": [255712000003]})
+    modules.queue_calls(app, Broadcast("Fire"), "Emergency", {255712000002})
+    assert calls.calls == [255712000003, 255712000001, 255712000009]
@@ -0,0 +1,93 @@
+import math
+import random
+import pytest
+from geo import EARTH_RADIUS, GridIndex, haversine, parse_area, point_in_polygon
+
+random.seed(38)
+POINTS = [(i, -6.8 + random.uniform(-0.3, 0.3), 39.2 + random.uniform(-0.3, 0.3)) for i in range(1, 20001)]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return GridIndex(lambda: iter(POINTS))
+
+
+@pytest.mark.parametrize("radius", [50, 900, 5000, 25000])
+def test_circle_matches_brute_force(index, radius):
+    area = {"lat": -6.8, "lon": 39.2, "radius": radius}
+    expected = [i for i, lat, lon in POINTS if haversine(-6.8, 39.2, lat, lon) <= radius]
+    assert list(index.query(area)) == expected
+
+
+def destination(lat, lon, bearing, distance):
+    # Point distance metres from (lat, lon) along the initial bearing, in degrees
+    angle, bearing = distance / EARTH_RADIUS, math.radians(bearing)
+    phi, lam = math.radians(lat), math.radians(lon)
+    phi2 = math.asin(math.sin(phi) * math.cos(angle) + math.cos(phi) * math.sin(angle) * math.cos(bearing))
+    lam2 = lam + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(phi),
+                            math.cos(angle) - math.sin(phi) * math.sin(phi2))
+    return math.degrees(phi2), math.degrees(lam2)
+
+
+@pytest.mark.parametrize("lat, lon, radius", [
+    # Centres placed so the northern edge falls just past a cell boundary
+    (-6.84493, 39.2, 5000),
+    (-6.792, 39.2, 500000),
+    (-11.5, 34.6, 250000),
+    (60.0, 10.0, 400000),
+])
+def test_circle_keeps_points_on_its_edge(lat, lon, radius):
+    # The bearings include due north and the cap's widest longitude
+    inside = [destination(lat, lon, bearing, radius - 1) for bearing in range(0, 360, 5)]
+    outside = [destination(lat, lon, bearing, radius + 1) for bearing in range(0, 360, 5)]
+    index = GridIndex(lambda: iter([(i, *point) for i, point in enumerate(inside + outside, 1)]))
+    assert list(index.query({"lat": lat, "lon": lon, "radius": radius})) == list(range(1, len(inside) + 1))
+
+
+def test_circle_around_a_pole():
+    points = [(1, 89.5, -170.0), (2, 89.5, 10.0), (3, 80.0, 0.0)]
+    index = GridIndex(lambda: iter(points))
+    assert list(index.query({"lat": 89.9, "lon": 0.0, "radius": 100000})) == [1, 2]
+
+
+@pytest.mark.parametrize("polygon", [
+    [[-6.9, 39.1], [-6.9, 39.3], [-6.7, 39.3]],
+    # Edges on cell boundaries
+    [[-6.9, 39.1], [-6.9, 39.2], [-6.8, 39.2], [-6.8, 39.1]],
+    # Concave, with a notch cutting back through the middle
+    [[-7.0, 39.0], [-6.6, 39.05], [-6.8, 39.2], [-6.6, 39.4], [-7.05, 39.35]],
+])
+def test_polygon_matches_brute_force(index, polygon):
+    expected = [i for i, lat, lon in POINTS if point_in_polygon(lat, lon, polygon)]
+    assert list(index.query({"polygon": polygon})) == expected
+
+
+def test_add_and_remove():
+    index = GridIndex(lambda: iter([(1, -6.8, 39.2), (2, -6.8001, 39.2001)]))
+    area = {"lat": -6.8, "lon": 39.2, "radius": 100}
+    assert list(index.query(area)) == [1, 2]
+    index.add(3, -6.8002, 39.2)
+    index.remove(1)
+    assert list(index.query(area)) == [2, 3]
+
+
+def test_reloads_when_data_version_moves():
+    version = [1]
+    index = GridIndex(lambda: iter([(1, -6.8, 39.2)]), lambda: version[0])
+    area = {"lat": -6.8, "lon": 39.2, "radius": 100}
+    assert list(index.query(area)) == [1]
+    index.remove(1)
+    assert list(index.query(area)) == []
+    version[0] = 2
+    assert list(index.query(area)) == [1]
+
+
+def test_parse_area():
+    assert parse_area() is None
+    assert parse_area("-6.8", "39.2", "500") == {"lat": -6.8, "lon": 39.2, "radius": 500.0}
+    assert parse_area(polygon="[[-6.9, 39.1], [-6.9, 39.3], [-6.7, 39.3]]") == \
+        {"polygon": [[-6.9, 39.1], [-6.9, 39.3], [-6.7, 39.3]]}
+    for kwargs in ({"lat": "1"}, {"lat": "95", "lon": "0", "radius": "1"}, {"lat": "0", "lon": "0", "radius": "0"},
+                   {"polygon": "[[1, 2], [3, 4]]"}):
+        with pytest.raises(ValueError):
+            parse_area(**kwargs)
@@ -0,0 +1,80 @@
+import csv
+import io
+import pytest
+from importer import detect_format, import_subscribers, IMPORT_ENCODING, REJECT_FIELDS
+
+
+def run_import(data, fmt="csv", batch_size=2):
+    stored = []
+    rejects = io.StringIO()
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding=IMPORT_ENCODING, newline='')
+    summary = import_subscribers(stored.extend, stream, fmt, csv.writer(rejects), batch_size)
+    return summary, stored, list(csv.reader(io.StringIO(rejects.getvalue())))
+
+
+def test_csv_accept_and_reject():
+    data = (
+        "phoneNumber,Occupation,Hostel,Latitude,Longitude\n"
+        "0712000001,staff,Hall 1,-6.78,39.2\n"
+        "0712000002,Student,,,\n"
+        "12345,Staff,,,\n"
+        "0712000003,Farmer,,,\n"
+        "+255712000001,Student,,,\n"
+        "0712000004,Student,,95,39\n"
+    ).encode()
+    summary, stored, rejects = run_import(data)
+    assert summary == {"rows": 6, "upserted": 2, "rejected": 4}
+    assert stored[0] == (255712000001, "Staff", None, None, "Hall 1", None, None, -6.78, 39.2, "Tigo")
+    assert stored[1][:2] == (255712000002, "Student")
+    assert rejects[0] == REJECT_FIELDS
+    assert [(row[0], row[3]) for row in rejects[1:]] == [
+        ("4", "MSISDN/Phone Number Not Clear"),
+        ("5", "Occupation Not Clear"),
+        ("6", "Duplicate In File"),
+        ("7", "Location Not Clear"),
+    ]
+
+
+def test_excel_byte_order_mark():
+    data = "﻿phoneNumber,Occupation\n0712000001,Staff\n".encode()
+    summary, stored, _ = run_import(data)
+    assert summary["upserted"] == 1
+    assert stored[0][:2] == (255712000001, "Staff")
+
+
+def test_ndjson():
+    data = b'{"msisdn": "0712000001", "occupation": "Student"}\n\nnot json\n[1, 2]\n'
+    summary, stored, rejects = run_import(data, "ndjson")
+    assert summary == {"rows": 3, "upserted": 1, "rejected": 2}
+    assert [row[3] for row in rejects[1:]] == ["Malformed Row", "Malformed Row"]
+
+
+def test_undecodable_file_stops_with_error():
+    data = b"phoneNumber,Occupation\n0712000001,Staff\n0712000002,St\xffudent\n"
+    summary, stored, _ = run_import(data)
+    assert "error" in summary
+    assert summary["upserted"] == len(stored)
+
+
+def test_csv_error_keeps_earlier_rows():
+    data = ("phoneNumber,Occupation\n0712000001,Staff\n0712000002,\"" + "x" * 200000 + "\"\n").encode()
+    summary, stored, _ = run_import(data, batch_size=10)
+    assert summary["error"].startswith("Unreadable after row 1")
+    assert [row[0] for row in stored] == [255712000001]
+
+
+@pytest.mark.parametrize("filename, fmt, expected", [
+    ("people.csv", None, "csv"),
+    ("PEOPLE.NDJSON", None, "ndjson"),
+    ("people.jsonl", None, "ndjson"),
+    ("upload", "CSV", "csv"),
+    ("people.csv", "ndjson", "ndjson"),
+])
+def test_detect_format(filename, fmt, expected):
+    assert detect_format(filename, fmt) == expected
+
+
+@pytest.mark.parametrize("filename, fmt", [("people.xlsx", None), ("upload", None), (None, None), ("a.csv", "xml")])
+def test_detect_format_rejects_unknown(filename, fmt):
+    with pytest.raises(ValueError):
+        detect_format(filename, fmt)
@@ -0,0 +1,42 @@
+import pytest
+from msisdn import normalize_msisdn, msisdn_to_e164
+
+
+@pytest.mark.parametrize("raw", [
+    "+255712345678",
+    "255712345678",
+    "00255712345678",
+    "0712345678",
+    "712345678",
+    "0712 345 678",
+    "+255 (712) 345-678",
+    "0712.345.678",
+    255712345678,
+    712345678,
+])
+def test_accepted_forms(raw):
+    assert normalize_msisdn(raw) == 255712345678
+
+
+def test_mobile_ranges():
+    assert normalize_msisdn("0612345678") == 255612345678
+    assert normalize_msisdn("0222123456") is None
+
+
+@pytest.mark.parametrize("raw", [
+    None,
+    "",
+    "+254712345678",
+    "071234567",
+    "07123456789",
+    "2557123456789",
+    "07123a5678",
+    "０７１２３４５６７８",
+    "not a number",
+])
+def test_rejected(raw):
+    assert normalize_msisdn(raw) is None
+
+
+def test_e164():
+    assert msisdn_to_e164(normalize_msisdn("0712345678")) == "+255712345678"
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+from model import DeliveryHealthModel, db
+from quarantine import QUARANTINE_THRESHOLD, due_for_probe, mark_probed, record_delivery_report
+from suppression import suppression_list, unsubscribe, UNSUBSCRIBED
+
+DEAD = 255712000001
+ALIVE = 255712000002
+
+
+def quarantine(msisdn):
+    for _ in range(QUARANTINE_THRESHOLD):
+        changed = record_delivery_report(msisdn, "Failed", "UserDoesNotExist")
+    return changed
+
+
+def test_repeated_dead_number_failures_quarantine(app):
+    assert quarantine(DEAD)
+    assert not record_delivery_report(ALIVE, "Failed", "InsufficientCredit")
+    assert due_for_probe() == [DEAD]
+    assert record_delivery_report(DEAD, "Success")
+    assert due_for_probe() == []
+
+
+def test_probed_numbers_wait_for_the_interval(app):
+    quarantine(DEAD)
+    mark_probed([DEAD])
+    assert due_for_probe() == []
+    assert due_for_probe(datetime.utcnow() + timedelta(days=8)) == [DEAD]
+
+
+def test_suppressed_numbers_are_not_probed(app):
+    quarantine(DEAD)
+    suppression_list.add(DEAD, UNSUBSCRIBED)
+    assert due_for_probe() == []
+
+
+def test_unsubscribe_forgets_delivery_health(app):
+    quarantine(DEAD)
+    unsubscribe(DEAD)
+    assert db.session.get(DeliveryHealthModel, DEAD) is None
+    assert DEAD in suppression_list
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+import scheduler
+from escalation import EscalationPolicy
+from model import ScheduledAlertModel, db
+from scheduler import AlertScheduler, CANCELLED, PENDING, SENT, parse_due_at, local_timezone
+
+
+def past(seconds):
+    return datetime.utcnow() - timedelta(seconds=seconds)
+
+
+def test_due_alerts_come_out_in_due_order(app):
+    alerts = AlertScheduler()
+    late = alerts.schedule("late", "x", past(10))
+    early = alerts.schedule("early", "x", past(30))
+    middle = alerts.schedule("middle", "x", past(20))
+    assert len(alerts) == 3
+    assert [alerts._next_due() for _ in range(3)] == [early.id, middle.id, late.id]
+
+
+def test_cancelled_alert_is_skipped(app):
+    alerts = AlertScheduler()
+    first = alerts.schedule("first", "x", past(20))
+    second = alerts.schedule("second", "x", past(10))
+    assert alerts.cancel(first.id)
+    assert not alerts.cancel(first.id)
+    assert len(alerts) == 1
+    assert db.session.get(ScheduledAlertModel, first.id).status == CANCELLED
+    assert alerts._next_due() == second.id
+
+
+def test_fire_sends_once_with_stored_policy(app, monkeypatch):
+    pulls = []
+    monkeypatch.setattr(scheduler, "subscriber_pull", lambda *args: pulls.append(args) or "broadcast")
+    alerts = AlertScheduler()
+    alert = alerts.schedule("Fire", "Block C", past(1), ttl=60, audience="Staff",
+                            area={"lat": -6.8, "lon": 39.2, "radius": 500},
+                            policy=EscalationPolicy(ratio=0.5, deadline=120, channel="sms"))
+    assert alerts.fire(alert.id) == "broadcast"
+    assert alerts.fire(alert.id) is None
+    title, description, policy, ttl, incident, audience, area = pulls[0]
+    assert (title, description, ttl, audience) == ("Fire", "Block C", 60, "Staff")
+    assert (policy.ratio, policy.deadline, policy.channel) == (0.5, 120, "sms")
+    assert area == {"lat": -6.8, "lon": 39.2, "radius": 500}
+    assert len(pulls) == 1
+    assert db.session.get(ScheduledAlertModel, alert.id).status == SENT
+
+
+def test_cancelled_alert_does_not_fire(app, monkeypatch):
+    monkeypatch.setattr(scheduler, "subscriber_pull", pytest.fail)
+    alerts = AlertScheduler()
+    alert = alerts.schedule("Fire", "x", past(1))
+    alerts.cancel(alert.id)
+    assert alerts.fire(alert.id) is None
+    assert db.session.get(ScheduledAlertModel, alert.id).status != PENDING
+
+
+def test_parse_due_at():
+    eat = local_timezone(3)
+    assert parse_due_at("2030-01-01T09:00:00", local=eat) == datetime(2030, 1, 1, 6, 0)
+    assert parse_due_at("2030-01-01T09:00:00+00:00", local=eat) == datetime(2030, 1, 1, 9, 0)
+    assert parse_due_at("2030-01-01T09:00:00") == datetime(2030, 1, 1, 9, 0)
+    delayed = parse_due_at(delay="60")
+    assert timedelta(seconds=55) < delayed - datetime.now(timezone.utc).replace(tzinfo=None) <= timedelta(seconds=60)
+    assert parse_due_at() is None
+
+
+@pytest.mark.parametrize("send_at, delay", [
+    (None, "inf"), (None, "nan"), (None, "1e12"), (None, "-60"), (None, "soon"),
+    ("tomorrow", None), ("0001-01-01T00:00:00", None),
+])
+def test_parse_due_at_rejects(send_at, delay):
+    with pytest.raises(ValueError):
+        parse_due_at(send_at, delay, local_timezone(3))
+
+
+def test_fire_without_policy_does_not_escalate(app, monkeypatch):
+    pulls = []
+    monkeypatch.setattr(scheduler, "subscriber_pull", lambda *args: pulls.append(args))
+    alerts = AlertScheduler()
+    alerts.fire(alerts.schedule("Fire", "x", past(1)).id)
+    assert pulls[0][2] is None
@@ -0,0 +1,31 @@
+from database import bump_data_version, data_version
+from model import SuppressionModel, db
+from suppression import SuppressionList, UNSUBSCRIBED, is_stop_request
+
+
+def test_reloads_when_another_process_suppresses(app):
+    numbers = SuppressionList(data_version)
+    assert 255712000001 not in numbers
+    # Another process writes the row and bumps the version
+    db.session.add(SuppressionModel(msisdn=255712000001, reason=UNSUBSCRIBED))
+    db.session.commit()
+    assert 255712000001 not in numbers
+    bump_data_version()
+    assert 255712000001 in numbers
+
+
+def test_own_change_does_not_reload(app):
+    numbers = SuppressionList(data_version)
+    loaded = numbers.numbers()
+    numbers.add(255712000001, UNSUBSCRIBED)
+    numbers.caught_up(bump_data_version())
+    assert numbers.numbers() is loaded
+    bump_data_version()
+    assert numbers.numbers() is not loaded
+
+
+def test_stop_keywords():
+    assert is_stop_request(" stop ")
+    assert is_stop_request("Stop All")
+    assert not is_stop_request("please stop")
+    assert not is_stop_request(None)
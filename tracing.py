@@ -0,0 +1,105 @@
+import logging
+import math
+import threading
+from datetime import datetime
+from flask import current_app
+from model import BroadcastTraceModel, db
+from broadcast import broadcasts
+from logs import log_failure
+
+TRACE_FLUSH_INTERVAL = 15
+TRACE_STAGES = ("resolved", "first_sent", "last_sent")
+DELIVERY_PERCENTILES = (50, 95, 99)
+TRACE_FIELDS = TRACE_STAGES + tuple(f"delivery_p{p}" for p in DELIVERY_PERCENTILES)
+
+log = logging.getLogger("dharura.tracing")
+
+
+def percentile(ordered, p):
+    # Nearest rank over an already sorted sequence
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def trace_row(broadcast, clear=True):
+    stages, deliveries = broadcast.take_trace(clear)
+    accepted = stages["accepted"]
+    row = BroadcastTraceModel(broadcast_id=broadcast.id, incident=broadcast.incident,
+                              release=current_app.config.get("RELEASE"),
+                              accepted_at=datetime.utcfromtimestamp(accepted),
+                              recipients=broadcast.sent, delivered=len(deliveries))
+    for stage in TRACE_STAGES:
+        if stage in stages:
+            setattr(row, stage, stages[stage] - accepted)
+    deliveries = sorted(deliveries)
+    for p in DELIVERY_PERCENTILES:
+        setattr(row, f"delivery_p{p}", percentile(deliveries, p))
+    return row
+
+
+def trace_dict(row):
+    return {
+        "id": row.broadcast_id,
+        "incident": row.incident,
+        "release": row.release,
+        "accepted_at": row.accepted_at.isoformat(),
+        **{field: getattr(row, field) for field in TRACE_FIELDS},
+        "recipients": row.recipients,
+        "delivered": row.delivered,
+    }
+
+
+def flush_traces():
+    # Stores the traces of broadcasts that reached a stage or got delivery
+    # reports since the last flush; stages are only marked in memory on the
+    # send path
+    changed = [broadcast for broadcast in broadcasts.all() if broadcast.trace_dirty]
+    try:
+        for broadcast in changed:
+            db.session.merge(trace_row(broadcast))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for broadcast in changed:
+            broadcast.trace_dirty = True
+        raise
+    return len(changed)
+
+
+def broadcast_trace(broadcast_id):
+    broadcast = broadcasts.get(broadcast_id)
+    if broadcast is not None:
+        return trace_dict(trace_row(broadcast, clear=False))
+    row = BroadcastTraceModel.query.get(broadcast_id)
+    return None if row is None else trace_dict(row)
+
+
+def recent_traces(since=None, release=None, limit=100):
+    # Newest first, with the p50/p95 of every stage across them
+    query = BroadcastTraceModel.query
+    if since is not None:
+        query = query.filter(BroadcastTraceModel.accepted_at >= since)
+    if release is not None:
+        query = query.filter_by(release=release)
+    rows = query.order_by(BroadcastTraceModel.accepted_at.desc()).limit(limit).all()
+    summary = {}
+    for field in TRACE_FIELDS:
+        values = sorted(getattr(row, field) for row in rows if getattr(row, field) is not None)
+        summary[field] = {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+    return [trace_dict(row) for row in rows], summary
+
+
+def start_trace_flusher(app, interval=TRACE_FLUSH_INTERVAL):
+    def run():
+        try:
+            with app.app_context():
+                flush_traces()
+        except Exception:
+            log_failure(log, "trace_flush_failed")
+        start_trace_flusher(app, interval)
+
+    timer = threading.Timer(interval, run)
+    timer.daemon = True
+    timer.start()
+    return timer
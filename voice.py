@@ -0,0 +1,80 @@
+import itertools
+import logging
+import queue
+import threading
+import africastalking
+from xml.sax.saxutils import escape
+from flask import current_app
+from msisdn import msisdn_to_e164
+from tenancy import per_app
+from logs import log_failure, log_success
+
+VOICE_CONCURRENCY = 10
+VOICE_QUEUE_SIZE = 10000
+# Lower rings first
+SEGMENT_PRIORITY = {"Staff": 0, "Student": 1}
+DEFAULT_PRIORITY = len(SEGMENT_PRIORITY)
+
+log = logging.getLogger("dharura.voice")
+
+SAY_RESPONSE = '<?xml version="1.0" encoding="UTF-8"?><Response><Say>{}</Say></Response>'
+
+
+class CallDispatcher:
+    def __init__(self, caller=None, concurrency=VOICE_CONCURRENCY):
+        # caller: the VOICE_NUMBER calls are placed from; None refuses calls
+        self.caller = caller
+        self.concurrency = concurrency
+        self._queue = queue.PriorityQueue(VOICE_QUEUE_SIZE)
+        self._order = itertools.count()
+        self._messages = {}
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._workers) < self.concurrency:
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def enqueue(self, msisdn, message, occupation=None, broadcast=None):
+        # Blocks while the queue is full; only call from background threads.
+        # Calls for a broadcast that expired or was superseded are dropped.
+        if not self.caller:
+            raise RuntimeError("VOICE_NUMBER is not configured")
+        self._start()
+        priority = SEGMENT_PRIORITY.get(occupation, DEFAULT_PRIORITY)
+        self._queue.put((priority, next(self._order), msisdn, message, broadcast))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            _, _, msisdn, message, broadcast = self._queue.get()
+            if broadcast is not None and broadcast.is_stale():
+                self._queue.task_done()
+                continue
+            self._messages[msisdn] = message
+            try:
+                response = africastalking.Voice.call(self.caller, [msisdn_to_e164(msisdn)])
+                log_success(log, "call_placed", msisdn=msisdn, response=response)
+            except Exception:
+                log_failure(log, "call_failed", msisdn=msisdn)
+                self._messages.pop(msisdn, None)
+            finally:
+                self._queue.task_done()
+
+    def say(self, msisdn, active=True):
+        # Text-to-speech document for the voice callback of a placed call
+        if not active:
+            self._messages.pop(msisdn, None)
+            return None
+        message = self._messages.get(msisdn)
+        if message is None:
+            return None
+        return SAY_RESPONSE.format(escape(message))
+
+
+call_dispatcher = per_app("call_dispatcher", lambda: CallDispatcher(current_app.config.get("VOICE_NUMBER")))